@@ -1,2 +1,20 @@
 from __future__ import absolute_import
-from .rsbhsm import (RSBHierarchicalStateMachine, RSBTransition, RSBState)
+import sys
+
+from .rsbhsm import (RSBState, RSBCondition)
+from .rsbhsm import (RSBLockedHierarchicalMachine, RSBHierarchicalMachine, RSBMachineFactory)
+from .rsbhsm import (RSBEventSupport, RSBTransitionSupport, RSBStateSupport, RSBMachineSupport)
+from .converters import (register_type, register_types, loaded_types)
+
+# graph machines import pygraphviz; they are loaded on first access where modules support __getattr__
+_GRAPH_CLASSES = ('RSBHierarchicalStateMachine', 'RSBHierarchicalGraphMachine', 'RSBTransition')
+
+if sys.version_info < (3, 7):
+    from .diagrams import (RSBHierarchicalStateMachine, RSBHierarchicalGraphMachine, RSBTransition)
+
+
+def __getattr__(name):
+    if name in _GRAPH_CLASSES:
+        from . import diagrams
+        return getattr(diagrams, name)
+    raise AttributeError("module '%s' has no attribute '%s'" % (__name__, name))
@@ -0,0 +1,23 @@
+import importlib
+import logging
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+_action_classes = {}  # path -> action class
+
+
+def resolve_action(path):
+    """ Return the class referenced by a path like 'my.action.Class'. Resolved classes are cached per process. """
+    try:
+        return _action_classes[path]
+    except KeyError:
+        pass
+    arr = path.split('.')
+    cls_name = arr[-1]
+    module_name = '.'.join(arr[:-1])
+    logger.debug('resolve action %s' % path)
+    module = importlib.import_module(module_name.lower())  # stick with module naming conventions
+    cls = getattr(module, cls_name)
+    _action_classes[path] = cls
+    return cls
@@ -0,0 +1,173 @@
+""" asyncio variant of the RSB state machine. It requires Python 3.5 or newer and is therefore
+not imported by `rsbhsm` itself:
+
+    from rsbhsm.aio import AsyncRSBMachine
+"""
+import asyncio
+import inspect
+import logging
+
+from transitions.core import listify
+from transitions.extensions.nesting import HierarchicalMachine, NestedEvent
+from six import string_types
+
+from .rsbhsm import RSBEventSupport, RSBMachineSupport, RSBNestedTransition, RSBState
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+class AsyncRSBEvent(RSBEventSupport, NestedEvent):
+
+    def set_rsb(self, scope, msg_type=None, linger=None, queue_size=None, queue_policy=None, coalesce=False,
+                msg_filter=None):
+        if queue_size is not None or queue_policy is not None or coalesce:
+            raise ValueError('Message queues are not supported by asynchronous machines')
+        super(AsyncRSBEvent, self).set_rsb(scope, msg_type, linger, msg_filter=msg_filter)
+
+    def activate(self):
+        # messages are handed over to the loop which activated the first listener unless a loop has been passed
+        if self.machine.loop is None:
+            self.machine.loop = asyncio.get_event_loop()
+        super(AsyncRSBEvent, self).activate()
+
+    async def trigger(self, model, *args, **kwargs):
+        return await self._trigger_async(model, False, args, kwargs)
+
+    async def _trigger_async(self, model, ignore_invalid, args, kwargs):
+        machine = self.machine
+        async with machine._get_async_lock(model):
+            # the model may have changed its state while waiting for the lock
+            if ignore_invalid and model.state not in machine._get_trigger_states(self.name):
+                return False
+            res, pending, error = machine._run(super(AsyncRSBEvent, self).trigger, model, *args, **kwargs)
+        # awaited without holding the lock since actions and callbacks may trigger the model
+        await machine._await_pending(pending, error)
+        return res
+
+    def _on_msg(self, rsb_event):
+        # called in the thread of the listener
+        if self.active and self._accept(rsb_event):
+            self.machine.loop.call_soon_threadsafe(self._schedule, rsb_event.data)
+
+    def _schedule(self, data):
+        if not self.active:
+            return
+        for model in self.machine._get_models_for(self.name):
+            task = asyncio.ensure_future(self._trigger_async(model, True, (), {'data': data}))
+            task.add_done_callback(self._report)
+
+    def _report(self, task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("processing message of scope %s failed: %s" % (self.scope, task.exception()))
+
+
+class AsyncRSBState(RSBState):
+
+    def __init__(self, *args, **kwargs):
+        if kwargs.get('async_action'):
+            raise ValueError('Actions of asynchronous machines should define coroutine methods instead')
+        super(AsyncRSBState, self).__init__(*args, **kwargs)
+
+    def _exit_action(self, action, event_data):
+        event_data.machine._defer(event_data.model, action.exit())
+
+
+class AsyncRSBMachine(RSBMachineSupport, HierarchicalMachine):
+    """ An RSB machine whose triggers are coroutines. Messages received by listeners are handed over to
+    the machine's event loop and triggers of one model are processed one after another.
+
+    Callbacks and actions may be coroutine functions. Their results are awaited in order once the transition
+    is done but before the trigger returns. They are awaited after the model has been released and may trigger
+    the model themselves. Conditions have to be synchronous.
+    """
+
+    def __init__(self, *args, **kwargs):
+        """
+        Args:
+            loop (asyncio.AbstractEventLoop): Loop which processes received messages. Defaults to the loop
+                in which the first listener is activated.
+            All other arguments are passed to RSBMachineSupport.
+        """
+        self.loop = kwargs.pop('loop', None)
+        # id(model) -> lock which serializes the triggers of a model
+        self._async_locks = {}
+        # id(model) -> awaitables returned by callbacks of the current transition
+        self._pending_actions = {}
+        super(AsyncRSBMachine, self).__init__(*args, **kwargs)
+
+    def start(self):
+        # listeners are activated in worker threads which have no event loop
+        if self.loop is None:
+            self.loop = asyncio.get_event_loop()
+        return super(AsyncRSBMachine, self).start()
+
+    async def to(self, model, state_name, *args, **kwargs):
+        async with self._get_async_lock(model):
+            _, pending, error = self._run(super(AsyncRSBMachine, self).to, model, state_name, *args, **kwargs)
+        await self._await_pending(pending, error)
+
+    async def dispatch_batch(self, items, ignore_invalid=False):
+        results = []
+        for model, trigger, kwargs in items:
+            try:
+                results.append(await self.events[trigger]._trigger_async(model, ignore_invalid, (), kwargs))
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def remove_model(self, model):
+        for m in listify(model):
+            self._async_locks.pop(id(m), None)
+        super(AsyncRSBMachine, self).remove_model(model)
+
+    def _get_async_lock(self, model):
+        try:
+            return self._async_locks[id(model)]
+        except KeyError:
+            return self._async_locks.setdefault(id(model), asyncio.Lock())
+
+    def _callback(self, func, event_data):
+        if isinstance(func, string_types):
+            func = getattr(event_data.model, func)
+        if self.send_event:
+            res = func(event_data)
+        else:
+            res = func(*event_data.args, **event_data.kwargs)
+        self._defer(event_data.model, res)
+
+    def _defer(self, model, res):
+        if inspect.isawaitable(res):
+            self._pending_actions.setdefault(id(model), []).append(res)
+
+    def _run(self, func, model, *args, **kwargs):
+        """ Call `func` and collect the awaitables returned by callbacks. Returns (result, awaitables, exception). """
+        res, error = None, None
+        try:
+            res = func(model, *args, **kwargs)
+        except Exception as e:
+            error = e
+        return res, self._pending_actions.pop(id(model), []), error
+
+    @staticmethod
+    async def _await_pending(pending, error=None):
+        for res in pending:
+            # all awaitables are processed even if one of them or the transition failed
+            try:
+                await res
+            except Exception as e:
+                error = error or e
+        if error is not None:
+            raise error
+
+    @staticmethod
+    def _create_transition(*args, **kwargs):
+        return RSBNestedTransition(*args, **kwargs)
+
+    @staticmethod
+    def _create_event(*args, **kwargs):
+        return AsyncRSBEvent(*args, **kwargs)
+
+    @staticmethod
+    def _create_state(*args, **kwargs):
+        return AsyncRSBState(*args, **kwargs)
@@ -0,0 +1,45 @@
+import importlib
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+_lock = threading.Lock()
+_message_classes = {}  # type string -> protobuf message class
+
+
+def register_type(msg_type):
+    """ Resolve the message class of an RST type string like 'rst.generic.Value' and register
+    a global converter for it. Every type is resolved and registered only once per process.
+    Returns the message class. """
+    try:
+        return _message_classes[msg_type]
+    except KeyError:
+        pass
+    with _lock:
+        if msg_type not in _message_classes:
+            # imported on first use to keep 'import rsbhsm' free of the middleware and protobuf
+            import rsb.converter
+            # used in dynamic rst message generation
+            import rst
+            import rstsandbox
+            logger.info('register type %s' % msg_type)
+            cls_name = msg_type.split('.')[-1]
+            module = importlib.import_module(msg_type + "_pb2")
+            cls = getattr(module, cls_name)
+            converter = rsb.converter.ProtocolBufferConverter(messageClass=cls)
+            rsb.converter.registerGlobalConverter(converter, True)
+            _message_classes[msg_type] = cls
+        return _message_classes[msg_type]
+
+
+def register_types(msg_types):
+    """ Register converters for a list of type strings up front. """
+    for msg_type in msg_types:
+        register_type(msg_type)
+
+
+def loaded_types():
+    """ Return the sorted list of type strings converters have been registered for. """
+    return sorted(_message_classes)
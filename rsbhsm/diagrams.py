@@ -0,0 +1,109 @@
+""" RSB machines with diagram support. They require pygraphviz and are kept apart from the other
+variants which do not import this module. """
+from transitions.extensions.factory import LockedHierarchicalGraphMachine, HierarchicalGraphMachine
+from transitions.extensions.factory import NestedGraphTransition
+from transitions.extensions.diagrams import GraphMachine, TransitionGraphSupport
+
+from .rsbhsm import RSBEvent, RSBMachineSupport, RSBNestedEvent, RSBTransitionSupport
+
+
+class RSBGraphTransitionSupport(TransitionGraphSupport):
+
+    def _change_state(self, event_data):
+        machine = event_data.machine
+        if machine.lazy_graph:
+            machine._record_transition(event_data.model, self.source, self.dest)
+            # skip the styling done by TransitionGraphSupport
+            super(TransitionGraphSupport, self)._change_state(event_data)
+        else:
+            super(RSBGraphTransitionSupport, self)._change_state(event_data)
+
+
+class RSBTransition(RSBTransitionSupport, RSBGraphTransitionSupport, NestedGraphTransition):
+    pass
+
+
+class RSBGraphSupport(GraphMachine):
+
+    def __init__(self, *args, **kwargs):
+        """
+        Args:
+            lazy_graph (bool): If True, transitions only record the previous state and the last transition
+                of a model. The graph is styled accordingly when it is retrieved with `get_graph` and cached
+                until the next state change. Defaults to False.
+            All other arguments are passed to the underlying machine.
+        """
+        self.lazy_graph = kwargs.pop('lazy_graph', False)
+        # id(model) -> (source, dest) of the last transition
+        self._graph_transitions = {}
+        # ids of models whose graph has not been styled since their last state change
+        self._stale_graphs = set()
+        super(RSBGraphSupport, self).__init__(*args, **kwargs)
+
+    def add_states(self, *args, **kwargs):
+        if not self.lazy_graph:
+            return super(RSBGraphSupport, self).add_states(*args, **kwargs)
+        # skip GraphMachine which redraws all graphs immediately
+        super(GraphMachine, self).add_states(*args, **kwargs)
+        self._invalidate_graphs()
+
+    def add_transition(self, *args, **kwargs):
+        if not self.lazy_graph:
+            return super(RSBGraphSupport, self).add_transition(*args, **kwargs)
+        super(GraphMachine, self).add_transition(*args, **kwargs)
+        self._invalidate_graphs()
+
+    def _invalidate_graphs(self):
+        for model in self.models:
+            if hasattr(model, 'graph'):
+                del model.graph
+                self._stale_graphs.add(id(model))
+
+    def _record_transition(self, model, source, dest):
+        self._graph_transitions[id(model)] = (source, dest)
+        self._stale_graphs.add(id(model))
+
+    def _get_graph(self, model, title=None, force_new=False):
+        graph = super(RSBGraphSupport, self)._get_graph(model, title=title, force_new=force_new)
+        if self.lazy_graph and (id(model) in self._stale_graphs or force_new):
+            self._style_graph(graph, model)
+            self._stale_graphs.discard(id(model))
+        return graph
+
+    def _style_graph(self, graph, model):
+        # same steps as TransitionGraphSupport._change_state, applied to the last transition only
+        source, dest = self._graph_transitions.get(id(model), (None, model.state))
+        dest = self.get_state(dest)
+        if source is not None:
+            source = self.get_state(source)
+            self.set_node_state(graph, source.name, state='previous')
+            if hasattr(source, 'children'):
+                while len(source.children) > 0:
+                    source = source.children[0]
+                while len(dest.children) > 0:
+                    dest = dest.children[0]
+            if graph.has_edge(source.name, dest.name):
+                self.set_edge_state(graph, source.name, dest.name, state='previous')
+        self.set_node_state(graph, dest.name, state='active', reset=True)
+
+
+class RSBHierarchicalStateMachine(RSBMachineSupport, RSBGraphSupport, LockedHierarchicalGraphMachine):
+
+    @staticmethod
+    def _create_transition(*args, **kwargs):
+        return RSBTransition(*args, **kwargs)
+
+    @staticmethod
+    def _create_event(*args, **kwargs):
+        return RSBEvent(*args, **kwargs)
+
+
+class RSBHierarchicalGraphMachine(RSBMachineSupport, RSBGraphSupport, HierarchicalGraphMachine):
+
+    @staticmethod
+    def _create_transition(*args, **kwargs):
+        return RSBTransition(*args, **kwargs)
+
+    @staticmethod
+    def _create_event(*args, **kwargs):
+        return RSBNestedEvent(*args, **kwargs)
@@ -0,0 +1,361 @@
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+def _deliver(subscribers, rsb_event):
+    """ Pass `rsb_event` to all `subscribers`. A failing subscriber does not prevent delivery to the others. """
+    for subscriber in subscribers:
+        try:
+            subscriber._on_msg(rsb_event)
+        except Exception:
+            logger.exception("processing message of scope %s failed" % rsb_event.scope)
+
+
+class Subscription(object):
+    """ An RSB listener on `scope` which forwards every received event to all of its subscribers. """
+
+    def __init__(self, scope, listener):
+        self.scope = scope
+        self.listener = listener
+        # replaced instead of modified to allow iteration in the listener thread without locking
+        self.subscribers = ()
+        self.attached = False
+        self.attach()
+
+    def _on_msg(self, rsb_event):
+        _deliver(self.subscribers, rsb_event)
+
+    def attach(self):
+        if not self.attached:
+            self.listener.addHandler(self._on_msg)
+            self.attached = True
+
+    def detach(self):
+        if self.attached:
+            self.listener.removeHandler(self._on_msg)
+            self.attached = False
+
+    def close(self):
+        self.detach()
+        self.listener.deactivate()
+
+
+def _components(scope):
+    """ Split a scope string or an RSB scope into its components. """
+    if hasattr(scope, 'components'):
+        return list(scope.components)
+    return [c for c in scope.split('/') if c]
+
+
+class ScopeTrie(object):
+    """ Maps scopes to subscribers. A lookup returns the subscribers of a scope and all of its ancestors
+    which mirrors the delivery of RSB listeners to subscopes. """
+
+    def __init__(self):
+        self.children = {}
+        # replaced instead of modified to allow lookups in the listener thread without locking
+        self.subscribers = ()
+
+    def __len__(self):
+        return len(self.subscribers) + sum(len(c) for c in self.children.values())
+
+    def add(self, components, subscriber):
+        node = self
+        for c in components:
+            node = node.children.setdefault(c, ScopeTrie())
+        if subscriber not in node.subscribers:
+            node.subscribers += (subscriber,)
+
+    def remove(self, components, subscriber):
+        """ Remove `subscriber` from the scope of `components` and prune empty nodes. Returns False if it has not
+        been subscribed. """
+        path = [self]
+        for c in components:
+            node = path[-1].children.get(c)
+            if node is None:
+                return False
+            path.append(node)
+        node = path[-1]
+        if subscriber not in node.subscribers:
+            return False
+        node.subscribers = tuple(s for s in node.subscribers if s is not subscriber)
+        for parent, c in zip(reversed(path[:-1]), reversed(components)):
+            child = parent.children[c]
+            if child.subscribers or child.children:
+                break
+            del parent.children[c]
+        return True
+
+    def lookup(self, components):
+        res = list(self.subscribers)
+        node = self
+        for c in components:
+            node = node.children.get(c)
+            if node is None:
+                break
+            res.extend(node.subscribers)
+        return res
+
+
+class _ScopeRouter(object):
+    """ Subscriber of a root scope which forwards events to the subscribers of the subscope they were sent to. """
+
+    def __init__(self, root):
+        self.offset = len(_components(root))
+        self.trie = ScopeTrie()
+
+    def add(self, scope, subscriber):
+        self.trie.add(_components(scope)[self.offset:], subscriber)
+
+    def remove(self, scope, subscriber):
+        return self.trie.remove(_components(scope)[self.offset:], subscriber)
+
+    def _on_msg(self, rsb_event):
+        _deliver(self.trie.lookup(_components(rsb_event.scope)[self.offset:]), rsb_event)
+
+
+class ScopeRegistry(object):
+    """ Keeps one reference-counted RSB listener per scope. Subscribers are objects with an `_on_msg`
+    method which is called for every event received on the subscribed scope.
+
+    If `pool_size` is larger than zero, listeners without subscribers are not destroyed but parked with
+    their handler detached. Up to `pool_size` parked listeners are kept and reused by the next
+    subscription of their scope. The least recently parked listener is destroyed when the pool is full.
+    Listeners parked for longer than `pool_idle` seconds are destroyed as well. If a `scheduler` (a `WorkerPool`)
+    is passed, they are destroyed in its threads once `pool_idle` has passed. Otherwise, idle listeners are only
+    destroyed when the pool is used the next time.
+
+    Scopes below one of the scopes in `roots` do not get their own listener. Instead, a single listener on the
+    closest root receives the events of the whole subtree and forwards them to the subscribers of the matching
+    scope and its ancestors.
+    """
+
+    def __init__(self, pool_size=0, pool_idle=None, roots=None, scheduler=None):
+        self._lock = threading.Lock()
+        self.scheduler = scheduler
+        # serializes changes of routed scopes together with the subscription of their root
+        self._route_lock = threading.Lock()
+        self.roots = sorted(set('/' + '/'.join(_components(r)) for r in roots or []), key=len, reverse=True)
+        self._routers = {}  # root -> _ScopeRouter
+        self._subscriptions = {}
+        self.pool_size = pool_size
+        self.pool_idle = pool_idle
+        self._pool = OrderedDict()  # scope -> (subscription, time of parking)
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def __len__(self):
+        return len(self._subscriptions)
+
+    def subscribe(self, scope, subscriber):
+        """ Add `subscriber` to the listener of `scope` which is created if necessary. Returns the listener. """
+        root = self._root_of(scope)
+        if root is not None:
+            with self._route_lock:
+                router = self._routers.get(root)
+                if router is None:
+                    router = self._routers[root] = _ScopeRouter(root)
+                router.add(scope, subscriber)
+                return self._subscribe(root, router)
+        return self._subscribe(scope, subscriber)
+
+    def unsubscribe(self, scope, subscriber):
+        """ Remove `subscriber` from `scope`. The listener is destroyed or parked when its last subscriber is gone. """
+        root = self._root_of(scope)
+        if root is not None:
+            with self._route_lock:
+                router = self._routers.get(root)
+                if router is None or not router.remove(scope, subscriber) or len(router.trie) > 0:
+                    return
+                del self._routers[root]
+                self._unsubscribe(root, router)
+            return
+        self._unsubscribe(scope, subscriber)
+
+    def _root_of(self, scope):
+        """ Return the closest root which is `scope` or one of its ancestors. """
+        if not self.roots:
+            return None
+        components = _components(scope)
+        for root in self.roots:
+            root_components = _components(root)
+            if components[:len(root_components)] == root_components:
+                return root
+        return None
+
+    def _subscribe(self, scope, subscriber):
+        listener = None
+        while True:
+            with self._lock:
+                sub = self._subscriptions.get(scope)
+                if sub is None:
+                    if listener is None:
+                        sub = self._unpark(scope)
+                    else:
+                        sub, listener = Subscription(scope, listener), None
+                if sub is not None:
+                    self._subscriptions[scope] = sub
+                    if subscriber not in sub.subscribers:
+                        sub.subscribers += (subscriber,)
+                    break
+            # created without holding the lock to allow listeners of different scopes to be created concurrently;
+            # imported on first use to keep 'import rsbhsm' free of the middleware
+            import rsb
+            logger.info("create listener for scope %s" % scope)
+            listener = rsb.createListener(scope)
+        if listener is not None:
+            # another subscriber has created a listener for the same scope in the meantime
+            listener.deactivate()
+        return sub.listener
+
+    def _unsubscribe(self, scope, subscriber):
+        with self._lock:
+            sub = self._subscriptions.get(scope)
+            if sub is None or subscriber not in sub.subscribers:
+                return
+            sub.subscribers = tuple(s for s in sub.subscribers if s is not subscriber)
+            if sub.subscribers:
+                return
+            del self._subscriptions[scope]
+            if self.pool_size > 0:
+                self._park(sub)
+                return
+        # closed without holding the lock to allow listeners of other scopes to be destroyed concurrently
+        logger.info("destroy listener for scope %s" % scope)
+        sub.close()
+
+    def pool_stats(self):
+        """ Return the number of pool hits and misses, evicted listeners and currently parked listeners. """
+        with self._lock:
+            self._evict_idle()
+            stats = dict(self._stats)
+            stats['parked'] = len(self._pool)
+            return stats
+
+    def evict_idle(self):
+        """ Destroy parked listeners which have not been used for `pool_idle` seconds. """
+        with self._lock:
+            self._evict_idle()
+
+    def clear_pool(self):
+        """ Destroy all parked listeners. """
+        for sub in self._take_parked():
+            sub.close()
+
+    def _take_parked(self):
+        """ Remove all parked listeners from the pool and return them without destroying them. """
+        with self._lock:
+            subs = [sub for sub, _ in self._pool.values()]
+            self._pool.clear()
+            return subs
+
+    def _park(self, sub):
+        logger.info("park listener for scope %s" % sub.scope)
+        sub.detach()
+        self._pool[sub.scope] = (sub, time.time())
+        while len(self._pool) > self.pool_size:
+            self._evict(next(iter(self._pool)))
+        self._evict_idle()
+        if self.pool_idle is not None and self.scheduler is not None:
+            self.scheduler.schedule(self.pool_idle, self.evict_idle)
+
+    def _unpark(self, scope):
+        if self.pool_size <= 0:
+            return None
+        self._evict_idle()
+        entry = self._pool.pop(scope, None)
+        if entry is None:
+            self._stats['misses'] += 1
+            return None
+        self._stats['hits'] += 1
+        sub = entry[0]
+        sub.attach()
+        return sub
+
+    def _evict(self, scope):
+        logger.info("evict listener for scope %s" % scope)
+        sub, _ = self._pool.pop(scope)
+        self._stats['evictions'] += 1
+        sub.close()
+
+    def _evict_idle(self):
+        if self.pool_idle is None:
+            return
+        deadline = time.time() - self.pool_idle
+        # entries are ordered by parking time
+        while self._pool and next(iter(self._pool.values()))[1] <= deadline:
+            self._evict(next(iter(self._pool)))
+
+
+class Inbox(object):
+    """ A bounded FIFO of received messages which is drained by a single consumer at a time.
+
+    If the inbox is full, `policy` decides what happens to a new message: 'block' waits until the consumer
+    has made room, 'drop_oldest' discards the oldest queued message and 'drop_newest' the new one.
+    'latest_only' keeps only the most recent message regardless of `size`.
+    """
+
+    policies = ['block', 'drop_oldest', 'drop_newest', 'latest_only']
+
+    def __init__(self, size, policy='block'):
+        if policy not in self.policies:
+            raise ValueError("Unknown queue policy '%s'. Use one of %s." % (policy, self.policies))
+        if size < 1:
+            raise ValueError('Queue size has to be at least 1')
+        self.size = 1 if policy == 'latest_only' else size
+        self.policy = policy
+        self._items = deque()
+        self._cond = threading.Condition()
+        self._draining = False
+        self._stats = {'received': 0, 'dropped': 0, 'max_depth': 0}
+
+    def __len__(self):
+        return len(self._items)
+
+    def put(self, item):
+        """ Queue `item` according to the policy. Returns True if the caller has to start draining the inbox. """
+        with self._cond:
+            self._stats['received'] += 1
+            if self.policy == 'block':
+                while len(self._items) >= self.size:
+                    self._cond.wait()
+            elif len(self._items) >= self.size:
+                self._stats['dropped'] += 1
+                if self.policy == 'drop_newest':
+                    return False
+                self._items.popleft()
+            self._items.append(item)
+            self._stats['max_depth'] = max(self._stats['max_depth'], len(self._items))
+            if self._draining:
+                return False
+            self._draining = True
+            return True
+
+    def get_batch(self, max_items):
+        """ Remove and return up to `max_items` of the oldest items. If the inbox is empty, an empty list
+        is returned and the inbox is marked as idle until the next `put`. """
+        with self._cond:
+            if not self._items:
+                self._draining = False
+                return []
+            batch = [self._items.popleft() for _ in range(min(max_items, len(self._items)))]
+            self._cond.notify_all()
+            return batch
+
+    def clear(self):
+        """ Discard all queued items. """
+        with self._cond:
+            self._stats['dropped'] += len(self._items)
+            self._items.clear()
+            self._cond.notify_all()
+
+    def stats(self):
+        """ Return the current depth and the number of received, dropped and at most queued items. """
+        with self._cond:
+            stats = dict(self._stats)
+            stats['depth'] = len(self._items)
+            return stats
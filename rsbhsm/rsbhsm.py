@@ -1,20 +1,19 @@
-from transitions.extensions import LockedHierarchicalGraphMachine as Machine
-from transitions.extensions.nesting import NestedState as State
-from transitions.extensions.factory import NestedGraphTransition as Transition
-from transitions.extensions.factory import LockedNestedEvent as Event
+from transitions.core import Machine, Transition, State, Event, Condition, listify
+from transitions.extensions.nesting import HierarchicalMachine, NestedState, NestedTransition, NestedEvent
+from transitions.extensions.locking import LockedMachine, LockedEvent
 
-import importlib
+import functools
 import logging
 import inspect
 import threading
+import time
+from collections import OrderedDict
 from six import string_types
 
-import rsb
-import rsb.converter
-
-# used in dynamic rst message generation
-import rst
-import rstsandbox
+from .actions import resolve_action
+from .converters import register_type
+from .listeners import Inbox, ScopeRegistry
+from .workers import Future, WorkerPool
 
 logging.getLogger("rsb").setLevel(logging.WARNING)
 logging.getLogger("rst").setLevel(logging.ERROR)
@@ -23,122 +22,790 @@ logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
 
 
-class RSBEvent(Event):
+# cancellation flag of the asynchronous action enter executed by the current thread
+_action_context = threading.local()
+
+
+class _unlocked(object):
+    """ Decorator for machine methods which must not be executed while holding the lock of a locked machine.
+    LockedMachine wraps bound methods only; the decorated function is returned as a plain function instead. """
+
+    def __init__(self, func):
+        self.func = func
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self.func
+        func = self.func
+
+        @functools.wraps(func)
+        def call(*args, **kwargs):
+            return func(obj, *args, **kwargs)
+        return call
+
+
+class RSBEventSupport(Event):
+
+    # queue size used if only a queue policy is passed
+    queue_size = 100
+    # maximum number of queued messages processed with one call of dispatch_batch
+    batch_size = 32
 
     def __init__(self, *args, **kwargs):
         self.scope = None
         self.listener = None
-        super(RSBEvent, self).__init__(*args, **kwargs)
+        # bounded queue between the listener and the machine's dispatcher; None dispatches in the listener thread
+        self.inbox = None
+        # evaluated in the listener thread; callables are passed the payload, RSB filters the whole event
+        self.filters = []
+        self.message_counts = {'filtered': 0, 'dispatched': 0}
+        self._counts_lock = threading.Lock()
+        # seconds to keep the listener after deactivation; None falls back to the machine's setting
+        self.linger = None
+        # False while the event is not valid; messages are discarded even if the listener still exists
+        self.active = False
+        self._listener_lock = threading.Lock()
+        # future of the scheduled destruction of the listener; cancelled when the event is activated again
+        self._teardown = None
+        super(RSBEventSupport, self).__init__(*args, **kwargs)
 
-    def set_rsb(self, scope, msg_type=None):
+    def set_rsb(self, scope, msg_type=None, linger=None, queue_size=None, queue_policy=None, coalesce=False,
+                msg_filter=None):
         if self.scope and scope is not self.scope:
             raise ValueError('Scope has been set already and cannot be reassigned')
+        if coalesce:
+            # only the newest message is kept while a previous one is processed
+            if queue_policy not in (None, 'latest_only'):
+                raise ValueError("Coalescing cannot be combined with queue policy '%s'" % queue_policy)
+            queue_policy = 'latest_only'
         self.scope = scope
+        if linger is not None:
+            self.linger = linger
+        if queue_size is not None or queue_policy is not None:
+            self.inbox = Inbox(queue_size or self.queue_size, queue_policy or 'block')
+        if msg_filter is not None:
+            self.filters.extend(listify(msg_filter))
         if isinstance(msg_type, string_types):
-            logger.info('register trype %s' % msg_type)
-            cls_name = msg_type.split('.')[-1]
-            x = importlib.import_module(msg_type + "_pb2")
-            cls = getattr(x, cls_name)
-            converter = rsb.converter.ProtocolBufferConverter(messageClass=cls)
-            rsb.converter.registerGlobalConverter(converter, True)
+            register_type(msg_type)
 
     def activate(self):
-        if self.scope is not None and self.listener is None:
-            logger.info("activate logger for scope %s" % self.scope)
-            self.listener = rsb.createListener(self.scope)
-            self.listener.addHandler(self._on_msg)
+        if self.scope is not None and not self.active:
+            with self._listener_lock:
+                self.active = True
+                if self._teardown is not None:
+                    self._teardown.cancel()
+                    self._teardown = None
+                if self.listener is None:
+                    logger.info("activate logger for scope %s" % self.scope)
+                    self.listener = self.machine._scopes.subscribe(self.scope, self)
+
+    def suspend(self):
+        """ Stop processing messages but keep the listener until `deactivate` is called. """
+        self.active = False
+
+    def schedule_deactivation(self, pool, delay):
+        """ Suspend the event and destroy its listener with `pool` after `delay` seconds unless the event is
+        activated again in the meantime. """
+        with self._listener_lock:
+            self.active = False
+            if self._teardown is not None:
+                self._teardown.cancel()
+            self._teardown = pool.schedule(delay, self.deactivate, force=False)
 
-    def deactivate(self):
+    def deactivate(self, force=True):
+        """ Destroy the listener of this event. If `force` is False, the listener is kept in case
+        the event has been activated again since it was suspended. """
         if self.listener is not None:
-            logger.info("deactivate logger for scope %s" % self.scope)
-            self.listener, tmp = None, self.listener
-            del tmp
+            with self._listener_lock:
+                if self.listener is not None and (force or not self.active):
+                    logger.info("deactivate logger for scope %s" % self.scope)
+                    self.active = False
+                    self.listener = None
+                    self.machine._scopes.unsubscribe(self.scope, self)
+                    if self.inbox is not None:
+                        self.inbox.clear()
+
+    def trigger(self, model, *args, **kwargs):
+        cancelled = getattr(_action_context, 'cancelled', None)
+        if cancelled is not None and cancelled.is_set():
+            logger.warning("ignore trigger %s of an action whose state has been exited" % self.name)
+            return False
+        lock = self.machine._get_model_lock(model)
+        if lock is None:
+            return super(RSBEventSupport, self).trigger(model, *args, **kwargs)
+        with lock:
+            return super(RSBEventSupport, self).trigger(model, *args, **kwargs)
+
+    def queue_stats(self):
+        """ Return depth, received, dropped and maximum queued messages or None if the event is not queued. """
+        return self.inbox.stats() if self.inbox is not None else None
+
+    def message_stats(self):
+        """ Return the number of filtered and dispatched messages. """
+        with self._counts_lock:
+            return dict(self.message_counts)
+
+    def _accept(self, rsb_event):
+        """ Return True if `rsb_event` passes all filters. """
+        try:
+            accepted = all(f.match(rsb_event) if hasattr(f, 'match') else f(rsb_event.data) for f in self.filters)
+        except Exception:
+            logger.exception("filter of scope %s failed" % self.scope)
+            accepted = False
+        with self._counts_lock:
+            self.message_counts['dispatched' if accepted else 'filtered'] += 1
+        return accepted
 
     def _on_msg(self, rsb_event):
-        for model in self.machine.models:
-            self.trigger(model, data=rsb_event.data)
+        if not self.active or not self._accept(rsb_event):
+            return
+        if self.inbox is None:
+            self._dispatch(rsb_event.data)
+        elif self.inbox.put(rsb_event.data):
+            self.machine._dispatcher.submit(self._drain)
 
+    def _drain(self):
+        machine = self.machine
+        while True:
+            batch = self.inbox.get_batch(self.batch_size)
+            if not batch:
+                return
+            # models are looked up when the batch reaches a message since previous messages may have changed
+            # their states; messages are discarded once the event has been suspended
+            items = ((model, self.name, {'data': data}) for data in batch if self.active
+                     for model in machine._get_models_for(self.name))
+            for res in machine.dispatch_batch(items, ignore_invalid=True):
+                if isinstance(res, Exception):
+                    logger.error("processing message of scope %s failed: %s" % (self.scope, res))
 
-class RSBTransition(Transition):
+    def _dispatch(self, data):
+        # models may have left their state before their trigger acquires the lock
+        items = [(model, self.name, {'data': data}) for model in self.machine._get_models_for(self.name)]
+        for res in self.machine.dispatch_batch(items, ignore_invalid=True):
+            if isinstance(res, Exception):
+                logger.error("processing message of scope %s failed: %s" % (self.scope, res))
 
-    def __init__(self, *args, **kwargs):
-        super(RSBTransition, self).__init__(*args, **kwargs)
+
+class RSBTransitionSupport(Transition):
 
     def _change_state(self, event_data):
-        trigger_src = event_data.machine.get_triggers(self.source)
-        trigger_dst = event_data.machine.get_triggers(self.dest)
+        machine = event_data.machine
+        # listeners which are no longer required are deactivated when the model's new state is indexed
+        activate = machine._get_listeners(self.dest)
+        super(RSBTransitionSupport, self)._change_state(event_data)
+        # the model has been indexed and keeps the events valid; listeners are created without holding the
+        # structure lock to not block transitions of other models
+        for ev in activate:
+            ev.activate()
 
-        evs = []
-        for t in trigger_src:
-            if t not in trigger_dst:
-                evs.append(event_data.machine.events[t])
 
-        threading.Thread(target=RSBTransition.deactivate,
-                         args=(evs,)).start()
+class RSBCondition(Condition):
+    """ The condition of RSB transitions which reads `send_event` from the instance dictionary of its machine.
+    Locked machines intercept every attribute access which makes the lookup of the setting the most expensive part
+    of evaluating a cheap condition. Named conditions are still looked up on the model. """
 
-        super(RSBTransition, self)._change_state(event_data)
-        for t in trigger_dst:
-            event_data.machine.events[t].activate()
+    def __init__(self, func, target=True, machine=None):
+        super(RSBCondition, self).__init__(func, target)
+        # reflects later changes of send_event
+        self._machine_attrs = vars(machine) if machine is not None else {'send_event': False}
+
+    def check(self, event_data):
+        predicate = getattr(event_data.model, self.func) if isinstance(self.func, string_types) else self.func
+        if self._machine_attrs['send_event']:
+            return predicate(event_data) == self.target
+        return predicate(*event_data.args, **event_data.kwargs) == self.target
 
-    @staticmethod
-    def deactivate(events):
-        for e in events:
-            e.deactivate()
 
+class RSBStateSupport(State):
 
-class RSBState(State):
+    # resolve action paths on first entry instead of at construction; can be overridden per state
+    lazy_action = False
+    action_lifecycles = ['entry', 'persistent', 'pooled']
 
     def __init__(self, *args, **kwargs):
+        """
+        Args:
+            action (string or class): Class (or its path) which is instantiated with the model
+                and whose `enter` and `exit` methods are called when the state is entered and exited.
+            lazy_action (bool): Resolve an action path on first entry instead of now.
+            action_lifecycle (string): 'entry' (default) creates a new action on every entry.
+                'persistent' creates one action per model which is kept between visits.
+                'pooled' behaves like 'persistent' but keeps at most `action_pool` actions; the least
+                recently used one is released if the pool is full. Kept actions are released when
+                the machine is shut down or the model is removed. Actions may implement a `release`
+                method to free their resources.
+            action_pool (int): Maximum number of kept actions of a 'pooled' state. Defaults to 8.
+            async_action (bool): Run the `enter` method of actions in a worker thread of the machine. The
+                transition does not wait for it. When the state is exited before `enter` has been started,
+                it is cancelled. If it is already running, the `cancelled` event of the action is set, triggers
+                of `enter` are ignored from then on and `exit` is called once `enter` has returned.
+            All other arguments are passed to the underlying state.
+        """
         action = kwargs.pop('action', None)
-        super(RSBState, self).__init__(*args, **kwargs)
-        self.action_cls = None
+        lazy_action = kwargs.pop('lazy_action', self.lazy_action)
+        self.action_lifecycle = kwargs.pop('action_lifecycle', 'entry')
+        self.action_pool = kwargs.pop('action_pool', 8)
+        self.async_action = kwargs.pop('async_action', False)
+        if self.action_lifecycle not in self.action_lifecycles:
+            raise ValueError("Unknown action lifecycle '%s'. Use one of %s."
+                             % (self.action_lifecycle, self.action_lifecycles))
+        super(RSBStateSupport, self).__init__(*args, **kwargs)
+        self._action_path = None
+        self._action_cls = None
         self.action = None
-        if action is not None:
-            if isinstance(action, basestring):
-                arr = action.split('.')
-                cls_name = arr[-1]
-                module_name = '.'.join(arr[:-1])
-                module = importlib.import_module(module_name.lower())  # stick with module naming conventions
-                cls = getattr(module, cls_name)
-                self.action_cls = cls
-            if inspect.isclass(action):
-                self.action_cls = action
+        # id(model) -> action of models currently in this state
+        self._entered_actions = {}
+        # id(model) -> action kept between visits; least recently used first
+        self._kept_actions = OrderedDict()
+        # id(model) -> _AsyncEnter of an asynchronous action enter
+        self._pending_enters = {}
+        self.action_stats = {'runs': 0, 'run_time': 0.0, 'cancelled': 0, 'interrupted': 0}
+        self._stats_lock = threading.Lock()
+        if isinstance(action, string_types):
+            self._action_path = action
+            if not lazy_action:
+                self.preload()
+        elif inspect.isclass(action):
+            self._action_cls = action
+
+    @property
+    def action_cls(self):
+        return self.preload()
+
+    def preload(self):
+        """ Resolve the action class if it has been passed as a string. """
+        if self._action_cls is None and self._action_path is not None:
+            self._action_cls = resolve_action(self._action_path)
+        return self._action_cls
 
     def enter(self, event_data):
-        super(RSBState, self).enter(event_data)
+        super(RSBStateSupport, self).enter(event_data)
         if self.action_cls:
-            self.action = self.action_cls(model=event_data.model)
-            event_data.machine._callback(self.action.enter, event_data)
+            self.action = self._get_action(event_data.model)
+            self._entered_actions[id(event_data.model)] = self.action
+            if self.async_action:
+                pending = _AsyncEnter(self.action)
+                self.action.cancelled = pending.cancelled
+                self._pending_enters[id(event_data.model)] = pending
+                pending.future = event_data.machine._action_workers.submit(self._enter_action, pending, event_data)
+            else:
+                event_data.machine._callback(self.action.enter, event_data)
 
     def exit(self, event_data):
-        if self.action:
-            self.action.exit()
-            del self.action
+        pending = self._pending_enters.pop(id(event_data.model), None)
+        action = self._entered_actions.pop(id(event_data.model), None)
+        if action is not None:
+            # actions whose enter has been cancelled are not exited and running ones are exited later
+            if pending is None or self._finish_enter(pending):
+                self._exit_action(action, event_data)
+            del action
             self.action = None
-        super(RSBState, self).exit(event_data)
+        super(RSBStateSupport, self).exit(event_data)
+
+    def _exit_action(self, action, event_data):
+        action.exit()
+
+    def _enter_action(self, pending, event_data):
+        action = pending.action
+        start = time.time()
+        _action_context.cancelled = pending.cancelled
+        try:
+            # the machine's _callback would acquire the machine lock
+            if event_data.machine.send_event:
+                action.enter(event_data)
+            else:
+                action.enter(*event_data.args, **event_data.kwargs)
+        finally:
+            _action_context.cancelled = None
+            with self._stats_lock:
+                self.action_stats['runs'] += 1
+                self.action_stats['run_time'] += time.time() - start
+                pending.finished = True
+                exit_pending = pending.exit_pending
+            if exit_pending:
+                self._exit_action(action, event_data)
+
+    def _finish_enter(self, pending):
+        """ Cancel a pending asynchronous enter or interrupt a running one. Returns True if the action can be
+        exited right away. """
+        if pending.future.cancel():
+            with self._stats_lock:
+                self.action_stats['cancelled'] += 1
+            return False
+        pending.cancelled.set()
+        with self._stats_lock:
+            if pending.finished:
+                return True
+            # waiting would block the machine and enter may be the one leaving the state
+            self.action_stats['interrupted'] += 1
+            pending.exit_pending = True
+        return False
+
+    def cancel_actions(self):
+        """ Cancel asynchronous enters which have not been started yet. Returns the number of cancelled enters. """
+        cancelled = 0
+        for pending in list(self._pending_enters.values()):
+            if not pending.future.done() and pending.future.cancel():
+                cancelled += 1
+        return cancelled
+
+    def release_actions(self, model=None):
+        """ Release the kept actions of `model` or of all models if `model` is None. """
+        keys = list(self._kept_actions.keys()) if model is None else [id(model)]
+        for key in keys:
+            action = self._kept_actions.pop(key, None)
+            if action is not None:
+                self._release(action)
+
+    def _get_action(self, model):
+        if self.action_lifecycle == 'entry':
+            return self.action_cls(model=model)
+        key = id(model)
+        action = self._kept_actions.pop(key, None)
+        if action is None:
+            action = self.action_cls(model=model)
+        self._kept_actions[key] = action
+        if self.action_lifecycle == 'pooled':
+            # evict the least recently used actions which are not entered at the moment
+            for k in [k for k in self._kept_actions if k not in self._entered_actions and k != key]:
+                if len(self._kept_actions) <= self.action_pool:
+                    break
+                self._release(self._kept_actions.pop(k))
+        return action
+
+    @staticmethod
+    def _release(action):
+        release = getattr(action, 'release', None)
+        if release is not None:
+            release()
+
+
+class _AsyncEnter(object):
+    """ State of an asynchronous action enter. """
+
+    def __init__(self, action):
+        self.action = action
+        self.future = None
+        # set when the state is exited; triggers of enter are ignored from then on
+        self.cancelled = threading.Event()
+        self.finished = False
+        # exit is called by the worker once enter has returned
+        self.exit_pending = False
+
+
+class RSBEvent(RSBEventSupport, LockedEvent, NestedEvent):
+    pass
+
+
+class RSBNestedEvent(RSBEventSupport, NestedEvent):
+    pass
+
+
+class RSBNestedTransition(RSBTransitionSupport, NestedTransition):
+    pass
+
+
+class RSBState(RSBStateSupport, NestedState):
+    pass
+
 
+class RSBMachineSupport(Machine):
 
-class RSBHierarchicalStateMachine(Machine):
+    # number of threads creating listeners in start and destroying them in shut_down
+    startup_workers = 8
+    shutdown_workers = 8
+
+    def __init__(self, *args, **kwargs):
+        """
+        Args:
+            listener_pool (int): Number of deactivated listeners which are kept for reuse instead of being
+                destroyed. Defaults to 0 which disables pooling.
+            listener_pool_idle (float): Seconds after which an unused pooled listener is destroyed.
+                Defaults to None which keeps listeners until they are evicted by newer ones.
+            scope_roots (list): Scopes whose subscopes share one listener on the root. Received messages are
+                routed to the events of the scope they were sent to. Defaults to None which creates one listener
+                per scope.
+            action_workers (int): Number of threads executing asynchronous actions. Defaults to 4.
+            linger (float): Seconds to wait before the listener of an event which is no longer valid is
+                destroyed. If the event becomes valid again in the meantime, the listener is kept.
+                Messages received while lingering are discarded. Defaults to 0. Can be overridden per
+                trigger by passing `linger` to `add_transition`.
+            dispatch_workers (int): Number of threads processing queued messages of events with a
+                `queue_size` or `queue_policy`. Messages of one event are processed in order. Defaults to 1.
+            autostart (bool): Call `start` at the end of the construction to activate the listeners of events
+                which are valid in the initial state. Defaults to False which activates listeners with the first
+                transition of a model.
+            lock_mode (string): 'machine' (default) serializes all triggers with the machine lock. 'model'
+                uses one lock per model instead so that triggers of different models run in parallel while
+                structural changes and listener bookkeeping are guarded by a separate machine-level lock.
+                Only supported by locked machines.
+            All other arguments are passed to the underlying machine.
+        """
+        self.lock_mode = kwargs.pop('lock_mode', 'machine')
+        autostart = kwargs.pop('autostart', False)
+        # done when the listeners activated by the last call of start are active
+        self.ready = None
+        if self.lock_mode not in ('machine', 'model'):
+            raise ValueError("Unknown lock mode '%s'. Use 'machine' or 'model'." % self.lock_mode)
+        # guards states, transitions, models and listener bookkeeping; always taken after a model lock
+        self._structure_lock = threading.RLock()
+        # id(model) -> lock of lock_mode 'model'
+        self._model_locks = {}
+        if self.lock_mode == 'model':
+            if not isinstance(self, LockedMachine):
+                raise ValueError("Lock mode 'model' requires a locked machine")
+            # triggers are not serialized by a machine-wide lock
+            kwargs.setdefault('context', [])
+        pool_size = kwargs.pop('listener_pool', 0)
+        pool_idle = kwargs.pop('listener_pool_idle', None)
+        scope_roots = kwargs.pop('scope_roots', None)
+        self.linger = kwargs.pop('linger', 0)
+        # processes messages of queued events
+        self._dispatcher = WorkerPool(kwargs.pop('dispatch_workers', 1), name='rsbhsm-dispatch')
+        # runs the enter method of asynchronous actions
+        self._action_workers = WorkerPool(kwargs.pop('action_workers', 4), name='rsbhsm-actions')
+        # dest -> events to activate; has to exist before Machine.__init__ adds the first states and transitions
+        self._dest_listeners = {}
+        # trigger -> states (including substates) from which the trigger is valid
+        self._trigger_states = {}
+        # state -> {id(model): model} of models currently in that state and id(model) -> state
+        self._models_by_state = {}
+        self._model_states = {}
+        # state -> scoped triggers valid in that state
+        self._state_triggers = {}
+        # scoped trigger -> number of models in states in which the trigger is valid; rebuilt when None
+        self._model_counts = None
+        # tears down listeners in the background to keep teardown out of the transition path
+        self._reaper = WorkerPool(1, name='rsbhsm-reaper')
+        # events on the same scope share one listener
+        self._scopes = ScopeRegistry(pool_size=pool_size, pool_idle=pool_idle, roots=scope_roots,
+                                     scheduler=self._reaper)
+        super(RSBMachineSupport, self).__init__(*args, **kwargs)
+        if autostart:
+            self.start()
+
+    def start(self):
+        """ Activate the listeners of all events which are valid in the current state of at least one model.
+        Listeners are created concurrently in the background. Returns a future which is done when all of them
+        are active. Its result is the number of activated events. Can be called again after models have been added. """
+        with self._structure_lock:
+            events = [ev for name, ev in self.events.items()
+                      if getattr(ev, 'scope', None) is not None and self._count_models(name) > 0]
+        ready = Future()
+        pool = WorkerPool(max(1, min(len(events), self.startup_workers)), name='rsbhsm-startup')
+        futures = [pool.submit(self._start_event, ev) for ev in events]
+        waiter = threading.Thread(target=self._await_start, args=(pool, futures, ready), name='rsbhsm-start')
+        waiter.daemon = True
+        waiter.start()
+        self.ready = ready
+        return ready
+
+    @_unlocked
+    def _start_event(self, ev):
+        """ Activate `ev` if it is still valid for a model. Returns False if all models have left in the meantime. """
+        with self._structure_lock:
+            if self._count_models(ev.name) == 0:
+                return False
+        # listeners are created without holding the structure lock to not block transitions of other models
+        ev.activate()
+        with self._structure_lock:
+            # the last model may have left and deactivated the event before it has been activated
+            if self._count_models(ev.name) == 0:
+                self._deactivate([ev])
+                return False
+        return True
+
+    @staticmethod
+    def _await_start(pool, futures, ready):
+        pool.shut_down()
+        ready._start()
+        errors = [e for e in (f.exception() for f in futures) if e is not None]
+        activated = sum(1 for f in futures if f.exception() is None and f.result())
+        ready._finish(result=activated, exception=errors[0] if errors else None)
+
+    def add_model(self, *args, **kwargs):
+        with self._structure_lock:
+            return super(RSBMachineSupport, self).add_model(*args, **kwargs)
+
+    def add_states(self, *args, **kwargs):
+        with self._structure_lock:
+            super(RSBMachineSupport, self).add_states(*args, **kwargs)
+            self._invalidate()
 
     def add_transition(self, *args, **kwargs):
         scope = kwargs.pop('scope', None)
         msg_type = kwargs.pop('type', None)
-        super(RSBHierarchicalStateMachine, self).add_transition(*args, **kwargs)
-        trigger_name = kwargs['trigger'] if 'trigger' in kwargs else args[0]
-        self.events[trigger_name].set_rsb(scope, msg_type)
+        linger = kwargs.pop('linger', None)
+        queue_size = kwargs.pop('queue_size', None)
+        queue_policy = kwargs.pop('queue_policy', None)
+        coalesce = kwargs.pop('coalesce', False)
+        msg_filter = kwargs.pop('filter', None)
+        with self._structure_lock:
+            super(RSBMachineSupport, self).add_transition(*args, **kwargs)
+            trigger_name = kwargs['trigger'] if 'trigger' in kwargs else args[0]
+            self.events[trigger_name].set_rsb(scope, msg_type, linger, queue_size, queue_policy, coalesce,
+                                              msg_filter)
+            self._bind_conditions(self.events[trigger_name])
+            self._invalidate()
+
+    def _bind_conditions(self, event):
+        """ Replace the conditions of `event` which have not been bound yet with `RSBCondition`. """
+        for transitions in event.transitions.values():
+            for t in transitions:
+                t.conditions = [c if isinstance(c, RSBCondition) else RSBCondition(c.func, c.target, self)
+                                for c in t.conditions]
+
+    def _invalidate(self):
+        """ Reset all caches derived from states and transitions. """
+        self._dest_listeners = {}
+        self._trigger_states = {}
+        self._state_triggers = {}
+        self._model_counts = None
+
+    def set_state(self, state, model=None):
+        super(RSBMachineSupport, self).set_state(state, model=model)
+        name = state if isinstance(state, string_types) else state.name
+        for m in self.models if model is None else listify(model):
+            self._index_model(m, name)
+
+    def _get_model_lock(self, model):
+        """ Return the lock of `model` or None if triggers are serialized by the machine lock. """
+        if self.lock_mode != 'model':
+            return None
+        try:
+            return self._model_locks[id(model)]
+        except KeyError:
+            with self._structure_lock:
+                return self._model_locks.setdefault(id(model), threading.RLock())
+
+    def _index_model(self, model, state):
+        key = id(model)
+        with self._structure_lock:
+            previous = self._model_states.get(key)
+            if previous is not None:
+                self._models_by_state[previous].pop(key, None)
+            if state is not None:
+                self._models_by_state.setdefault(state, {})[key] = model
+                self._model_states[key] = state
+            else:
+                self._model_states.pop(key, None)
+            if previous == state:
+                return
+            left = self._get_state_triggers(previous) if previous is not None else set()
+            entered = self._get_state_triggers(state) if state is not None else set()
+            if self._model_counts is not None:
+                for t in left - entered:
+                    self._model_counts[t] -= 1
+                for t in entered - left:
+                    self._model_counts[t] = self._model_counts.get(t, 0) + 1
+            # listeners are kept as long as other models are in states in which their event is valid
+            unused = [self.events[t] for t in left - entered if self._count_models(t) == 0]
+            if unused:
+                self._deactivate(unused)
+
+    def _get_state_triggers(self, state):
+        try:
+            return self._state_triggers[state]
+        except KeyError:
+            triggers = set(t for t in self.get_triggers(state) if getattr(self.events[t], 'scope', None) is not None)
+            self._state_triggers[state] = triggers
+            return triggers
+
+    def _count_models(self, trigger):
+        """ Return the number of models in states in which `trigger` is valid. """
+        with self._structure_lock:
+            if self._model_counts is None:
+                counts = {}
+                for state, models in self._models_by_state.items():
+                    if models:
+                        for t in self._get_state_triggers(state):
+                            counts[t] = counts.get(t, 0) + len(models)
+                self._model_counts = counts
+            return self._model_counts.get(trigger, 0)
+
+    def _get_models_for(self, trigger):
+        """ Return all models which are currently in a state from which `trigger` is valid. """
+        with self._structure_lock:
+            models = []
+            for state in self._get_trigger_states(trigger):
+                models.extend(self._models_by_state.get(state, {}).values())
+            return models
+
+    def _get_trigger_states(self, trigger):
+        with self._structure_lock:
+            try:
+                return self._trigger_states[trigger]
+            except KeyError:
+                states = self._compute_trigger_states(trigger)
+                self._trigger_states[trigger] = states
+                return states
+
+    def _compute_trigger_states(self, trigger):
+        sources = self.events[trigger].transitions
+        states = []
+        for state in self.states.values():
+            s = state
+            while s is not None and s.name not in sources:
+                s = getattr(s, 'parent', None)
+            if s is not None:
+                states.append(state.name)
+        return states
+
+    def dispatch_batch(self, items, ignore_invalid=False):
+        """ Process many triggers at once. `items` is an iterable of (model, trigger, kwargs) tuples which are
+        processed in order while the machine lock is held. Events and the states from which they are valid
+        are looked up once per trigger. Returns a list with the result of every item which is either the
+        return value of the trigger or the exception it raised. If `ignore_invalid` is True, items whose
+        trigger is not valid in the current state of their model are skipped and result in False. """
+        # the event's trigger is still required to acquire the model lock or to enqueue the transition
+        direct = self.lock_mode == 'machine' and not self.has_queue
+        events = {}
+        results = []
+        for model, trigger, kwargs in items:
+            try:
+                try:
+                    event, valid = events[trigger]
+                except KeyError:
+                    event, valid = events.setdefault(trigger, (self.events[trigger],
+                                                               set(self._get_trigger_states(trigger))))
+                if ignore_invalid and model.state not in valid:
+                    results.append(False)
+                elif direct:
+                    results.append(event._trigger(model, **kwargs))
+                else:
+                    results.append(event.trigger(model, **kwargs))
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def _deactivate(self, events):
+        """ Suspend `events` immediately and destroy their listeners in the background,
+        after their linger period has passed. """
+        for ev in events:
+            ev.schedule_deactivation(self._reaper, ev.linger if ev.linger is not None else self.linger)
+
+    def _get_listeners(self, dest):
+        """ Return the events whose listeners have to be activated when a model enters state `dest`.
+        Listeners which are no longer required are deactivated by `_index_model` based on the model counts.
+        Results are cached until states or transitions change. """
+        try:
+            return self._dest_listeners[dest]
+        except KeyError:
+            with self._structure_lock:
+                activate = self._dest_listeners[dest] = self._compute_listeners(dest)
+                return activate
+
+    def _compute_listeners(self, dest):
+        # only events bound to a scope own a listener; activate() is idempotent and also covers
+        # events valid in both states which have not been activated yet (e.g. in the initial state)
+        return [self.events[t] for t in set(self.get_triggers(dest)) if self.events[t].scope is not None]
 
     @staticmethod
     def _create_state(*args, **kwargs):
         return RSBState(*args, **kwargs)
 
+    def remove_model(self, model):
+        with self._structure_lock:
+            for m in listify(model):
+                # listeners only required by the removed model are destroyed
+                self._index_model(m, None)
+                self._model_locks.pop(id(m), None)
+                for state in self.states.values():
+                    if isinstance(state, RSBStateSupport):
+                        state.release_actions(m)
+            super(RSBMachineSupport, self).remove_model(model)
+
+    def preload(self):
+        """ Resolve the actions of all states in one pass instead of on their first entry. """
+        for state in self.states.values():
+            if isinstance(state, RSBStateSupport):
+                state.preload()
+
+    def listener_pool_stats(self):
+        """ Return hits, misses, evictions and the number of parked listeners of the listener pool. """
+        return self._scopes.pool_stats()
+
+    def message_stats(self):
+        """ Return the number of filtered and dispatched messages of all events with a scope by trigger name. """
+        return dict((name, ev.message_stats()) for name, ev in self.events.items()
+                    if getattr(ev, 'scope', None) is not None)
+
+    def queue_stats(self):
+        """ Return the queue statistics of all queued events by trigger name. """
+        return dict((name, ev.queue_stats()) for name, ev in self.events.items()
+                    if getattr(ev, 'inbox', None) is not None)
+
+    @_unlocked
+    def shut_down(self, timeout=None):
+        """ Destroy all listeners, stop all background threads and release kept actions. Listeners are destroyed
+        concurrently and lingering deactivations are executed immediately. Asynchronous action enters which
+        have not been started are cancelled. Returns a report with the scopes of listeners and the names of
+        threads which did not finish within `timeout` seconds as well as the number of cancelled enters.
+        Locked machines do not hold their lock while waiting since background tasks may require it. """
+        deadline = None if timeout is None else time.time() + timeout
+
+        def remaining():
+            return None if deadline is None else max(0, deadline - time.time())
+
+        stalled = self._reaper.shut_down(remaining())
+        cancelled = 0
+        for state in self.states.values():
+            if isinstance(state, RSBStateSupport):
+                cancelled += state.cancel_actions()
+        teardown = WorkerPool(self.shutdown_workers, name='rsbhsm-teardown')
+        # listeners are destroyed instead of being parked
+        pool_size, self._scopes.pool_size = self._scopes.pool_size, 0
+        # (scope, future) of every listener which is destroyed
+        pending = [(ev.scope, teardown.submit(ev.deactivate)) for ev in self.events.values()
+                   if getattr(ev, 'listener', None) is not None]
+        pending += [(sub.scope, teardown.submit(sub.close)) for sub in self._scopes._take_parked()]
+        stalled += teardown.shut_down(remaining())
+        self._scopes.pool_size = pool_size
+        stalled += self._dispatcher.shut_down(remaining())
+        stalled += self._action_workers.shut_down(remaining())
+        for state in self.states.values():
+            if isinstance(state, RSBStateSupport):
+                state.release_actions()
+        report = {'listeners': sorted(set(scope for scope, future in pending if not future.done())),
+                  'threads': [t.name for t in stalled],
+                  'cancelled': cancelled}
+        if report['listeners'] or report['threads']:
+            logger.warning("shut down incomplete after %s seconds: %s" % (timeout, report))
+        return report
+
+
+class RSBLockedHierarchicalMachine(RSBMachineSupport, LockedMachine, HierarchicalMachine):
+
     @staticmethod
     def _create_transition(*args, **kwargs):
-        return RSBTransition(*args, **kwargs)
+        return RSBNestedTransition(*args, **kwargs)
 
     @staticmethod
     def _create_event(*args, **kwargs):
         return RSBEvent(*args, **kwargs)
 
-    def shut_down(self):
-        for ev in self.events.values():
-            ev.deactivate()
+
+class RSBHierarchicalMachine(RSBMachineSupport, HierarchicalMachine):
+
+    @staticmethod
+    def _create_transition(*args, **kwargs):
+        return RSBNestedTransition(*args, **kwargs)
+
+    @staticmethod
+    def _create_event(*args, **kwargs):
+        return RSBNestedEvent(*args, **kwargs)
+
+
+class RSBMachineFactory(object):
+
+    # get one of the predefined RSB machines; all of them support nested states
+    @staticmethod
+    def get_predefined(graph=False, locked=False):
+        if graph:
+            # graph machines require pygraphviz and are only imported when they are requested
+            from .diagrams import RSBHierarchicalStateMachine, RSBHierarchicalGraphMachine
+            return RSBHierarchicalStateMachine if locked else RSBHierarchicalGraphMachine
+        elif locked:
+            return RSBLockedHierarchicalMachine
+        else:
+            return RSBHierarchicalMachine
@@ -0,0 +1,270 @@
+import logging
+import multiprocessing
+import threading
+import zlib
+
+from transitions.core import listify
+
+from .listeners import ScopeRegistry
+from .rsbhsm import RSBHierarchicalMachine
+from .workers import WorkerPool
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+# transition arguments which are handled by the parent process
+_RSB_ARGUMENTS = ('scope', 'type', 'filter')
+# arguments of RSB machines which are not supported since messages are forwarded in the listener thread
+_UNSUPPORTED = ('linger', 'queue_size', 'queue_policy', 'coalesce')
+
+
+def _strip_rsb(transitions):
+    return [dict((k, v) for k, v in t.items() if k not in _RSB_ARGUMENTS) if isinstance(t, dict) else t
+            for t in transitions]
+
+
+def _work(conn, machine_cls, definition, model_factory):
+    """ Main loop of a shard. Executes commands of the parent and replies with (success, result, changes)
+    where `changes` maps the keys of models whose state has changed to their new state. """
+    machine = machine_cls(add_self=False, **definition)
+    models = {}
+    states = {}
+    while True:
+        cmd, args = conn.recv()
+        if cmd == 'stop':
+            machine.shut_down()
+            conn.send((True, None, {}))
+            break
+        touched = []
+        try:
+            if cmd == 'add':
+                key, model_args = args
+                model = model_factory(key, *model_args)
+                machine.add_model(model)
+                models[key] = model
+                touched = [key]
+                res = None
+            elif cmd == 'remove':
+                machine.remove_model(models.pop(args))
+                states.pop(args, None)
+                res = None
+            elif cmd == 'trigger':
+                key, trigger, kwargs = args
+                touched = [key]
+                res = machine.events[trigger].trigger(models[key], **kwargs)
+            elif cmd == 'dispatch':
+                trigger, data = args
+                items = [(model, trigger, {'data': data}) for model in machine._get_models_for(trigger)]
+                touched = [model.shard_key for model, _, _ in items]
+                res = [r for r in machine.dispatch_batch(items, ignore_invalid=True) if isinstance(r, Exception)]
+                for e in res:
+                    logger.error("processing message for trigger %s failed: %s" % (trigger, e))
+                res = len(items)
+            elif cmd == 'collect':
+                res = dict((key, getattr(model, args, None)) for key, model in models.items())
+            else:
+                raise ValueError("Unknown command '%s'" % cmd)
+            success = True
+        except Exception as e:
+            success, res = False, e
+        changes = {}
+        for key in touched:
+            if key in models and states.get(key) != models[key].state:
+                states[key] = changes[key] = models[key].state
+        try:
+            conn.send((success, res, changes))
+        except Exception as e:
+            # results or exceptions which cannot be pickled
+            conn.send((False, RuntimeError(repr(e)), changes))
+
+
+class _Route(object):
+    """ Subscriber of a scope which forwards messages of one trigger to the shards. """
+
+    def __init__(self, sharded, trigger):
+        self.sharded = sharded
+        self.trigger = trigger
+
+    def _on_msg(self, rsb_event):
+        self.sharded._route(self.trigger, rsb_event)
+
+
+class ShardedMachine(object):
+    """ Distributes models across `shards` worker processes by a stable hash of their key. Every worker runs a copy
+    of the machine definition without RSB listeners. Listeners are managed by the parent process which forwards
+    messages to the shards which have models in states in which the trigger is valid.
+
+    Models are created in the workers by `model_factory(key, *args)` which has to be picklable like
+    all other arguments. Models get the attribute `shard_key`.
+
+    Messages are forwarded in the thread of the listener. Lingering listeners and message queues are
+    not supported.
+    """
+
+    def __init__(self, model_factory, shards=2, machine_cls=RSBHierarchicalMachine, **kwargs):
+        """
+        Args:
+            model_factory (callable): Called with a key and further arguments of `add_model` in a worker.
+            shards (int): Number of worker processes.
+            machine_cls (class): Machine class used in the workers. Defaults to `RSBHierarchicalMachine`.
+            All other arguments define the machine. Transitions may use the RSB arguments `scope`, `type`
+                and `filter`.
+        """
+        transitions = listify(kwargs.get('transitions', []))
+        for arg in _UNSUPPORTED:
+            if arg in kwargs or any(isinstance(t, dict) and arg in t for t in transitions):
+                raise ValueError("'%s' is not supported by sharded machines" % arg)
+        self.shards = shards
+        # provides scopes, filters and the states in which triggers are valid
+        self._template = machine_cls(add_self=False, **kwargs)
+        definition = dict(kwargs)
+        definition['transitions'] = _strip_rsb(transitions)
+        factory = _ShardModelFactory(model_factory)
+        self._conns = []
+        self._locks = []
+        self._processes = []
+        for i in range(shards):
+            parent_conn, child_conn = multiprocessing.Pipe()
+            p = multiprocessing.Process(target=_work, name='rsbhsm-shard-%d' % i,
+                                        args=(child_conn, machine_cls, definition, factory))
+            p.daemon = True
+            p.start()
+            self._conns.append(parent_conn)
+            self._locks.append(threading.Lock())
+            self._processes.append(p)
+        self._lock = threading.RLock()
+        # key -> (shard, state)
+        self._models = {}
+        # scoped trigger -> number of models per shard in states in which the trigger is valid
+        self._counts = {}
+        self._routes = {}
+        self._scopes = ScopeRegistry(roots=kwargs.get('scope_roots'))
+        # (un)subscribes scopes outside of listener threads which may be forwarding a message
+        self._reaper = WorkerPool(1, name='rsbhsm-shard-routes')
+
+    def shard_of(self, key):
+        """ Return the index of the shard of `key`. """
+        return zlib.crc32(str(key).encode('utf-8')) % self.shards
+
+    def add_model(self, key, *args):
+        """ Create a model in the shard of `key` and return its state. """
+        if key in self._models:
+            raise ValueError("Model '%s' has been added already" % key)
+        self._request(self.shard_of(key), 'add', (key, args))
+        return self.state(key)
+
+    def remove_model(self, key):
+        shard, _ = self._models[key]
+        self._request(shard, 'remove', key)
+        self._apply(shard, {key: None})
+
+    def trigger(self, key, trigger, **kwargs):
+        """ Trigger an event for the model of `key` and return the result. """
+        return self._request(self._models[key][0], 'trigger', (key, trigger, kwargs))
+
+    def state(self, key):
+        return self._models[key][1]
+
+    def states(self):
+        """ Return the states of all models by key. """
+        with self._lock:
+            return dict((key, state) for key, (_, state) in self._models.items())
+
+    def collect(self, attribute):
+        """ Return the value of `attribute` of all models by key. Missing attributes are None. """
+        res = {}
+        for values in self._request_all(range(self.shards), 'collect', attribute):
+            res.update(values)
+        return res
+
+    def shut_down(self, timeout=None):
+        self._reaper.shut_down()
+        for trigger, route in self._routes.items():
+            self._scopes.unsubscribe(self._template.events[trigger].scope, route)
+        self._routes = {}
+        self._request_all(range(self.shards), 'stop', None)
+        for p in self._processes:
+            p.join(timeout)
+        self._template.shut_down()
+
+    def _route(self, trigger, rsb_event):
+        event = self._template.events[trigger]
+        if not event._accept(rsb_event):
+            return
+        with self._lock:
+            shards = [i for i, n in enumerate(self._counts.get(trigger, [])) if n > 0]
+        if shards:
+            self._request_all(shards, 'dispatch', (trigger, rsb_event.data))
+
+    def _request(self, shard, cmd, args):
+        return self._request_all([shard], cmd, args)[0]
+
+    def _request_all(self, shards, cmd, args):
+        """ Send a command to all `shards` before waiting for their replies to let them work in parallel. """
+        shards = sorted(shards)
+        for i in shards:
+            self._locks[i].acquire()
+        try:
+            for i in shards:
+                self._conns[i].send((cmd, args))
+            replies = [self._conns[i].recv() for i in shards]
+        finally:
+            for i in shards:
+                self._locks[i].release()
+        results = []
+        error = None
+        for i, (success, res, changes) in zip(shards, replies):
+            self._apply(i, changes)
+            if not success:
+                error = error or res
+            results.append(res)
+        if error is not None:
+            raise error
+        return results
+
+    def _apply(self, shard, changes):
+        """ Update the states of models and the number of models per trigger and shard. """
+        if not changes:
+            return
+        template = self._template
+        touched = set()
+        with self._lock:
+            for key, state in changes.items():
+                _, previous = self._models.get(key, (shard, None))
+                if state is None:
+                    self._models.pop(key, None)
+                else:
+                    self._models[key] = (shard, state)
+                left = template._get_state_triggers(previous) if previous is not None else set()
+                entered = template._get_state_triggers(state) if state is not None else set()
+                for t in left - entered:
+                    self._counts[t][shard] -= 1
+                for t in entered - left:
+                    self._counts.setdefault(t, [0] * self.shards)[shard] += 1
+                touched.update(left ^ entered)
+        if touched:
+            self._reaper.submit(self._update_routes, touched)
+
+    def _update_routes(self, triggers):
+        """ Subscribe the scopes of `triggers` which are valid for at least one model and unsubscribe the others. """
+        for t in triggers:
+            with self._lock:
+                required = sum(self._counts.get(t, [])) > 0
+            scope = self._template.events[t].scope
+            if required and t not in self._routes:
+                self._routes[t] = _Route(self, t)
+                self._scopes.subscribe(scope, self._routes[t])
+            elif not required and t in self._routes:
+                self._scopes.unsubscribe(scope, self._routes.pop(t))
+
+
+class _ShardModelFactory(object):
+    """ Creates models with `factory` and assigns their shard key. """
+
+    def __init__(self, factory):
+        self.factory = factory
+
+    def __call__(self, key, *args):
+        model = self.factory(key, *args)
+        model.shard_key = key
+        return model
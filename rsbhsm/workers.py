@@ -0,0 +1,154 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+class Future(object):
+    """ Result of a task submitted to a `WorkerPool`. """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._running = False
+        self._cancelled = False
+        self._result = None
+        self._exception = None
+
+    def cancel(self):
+        """ Cancel the task if it has not been started yet. Returns True if the task will not be executed. """
+        with self._lock:
+            if self._running or self._done.is_set():
+                return self._cancelled
+            self._cancelled = True
+        self._done.set()
+        return True
+
+    def cancelled(self):
+        return self._cancelled
+
+    def running(self):
+        return self._running and not self._done.is_set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """ Block until the task is finished or cancelled. Returns False if `timeout` passed before. """
+        self._done.wait(timeout)
+        return self._done.is_set()
+
+    def exception(self, timeout=None):
+        """ Return the exception raised by the task or None if it succeeded. """
+        if not self.wait(timeout):
+            raise RuntimeError('Task did not finish within %s seconds' % timeout)
+        return self._exception
+
+    def result(self, timeout=None):
+        if not self.wait(timeout):
+            raise RuntimeError('Task did not finish within %s seconds' % timeout)
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def _start(self):
+        with self._lock:
+            if self._cancelled:
+                return False
+            self._running = True
+            return True
+
+    def _finish(self, result=None, exception=None):
+        self._result = result
+        self._exception = exception
+        self._done.set()
+
+
+class WorkerPool(object):
+    """ A fixed number of daemon threads processing tasks in order of their due time.
+    Threads are started on the first submission and can be stopped with `shut_down`. A stopped pool
+    restarts its threads when new tasks are submitted. """
+
+    def __init__(self, size=1, name='rsbhsm-worker'):
+        if size < 1:
+            raise ValueError('WorkerPool requires at least one thread')
+        self.size = size
+        self.name = name
+        self._cond = threading.Condition()
+        self._tasks = []  # heap of (due time, sequence number, future, func, args, kwargs)
+        self._sequence = itertools.count()
+        self._unfinished = 0
+        self._stopping = False
+        self._threads = []
+
+    def submit(self, func, *args, **kwargs):
+        return self.schedule(0, func, *args, **kwargs)
+
+    def schedule(self, delay, func, *args, **kwargs):
+        """ Execute `func` not before `delay` seconds have passed. """
+        future = Future()
+        with self._cond:
+            if not self._threads:
+                self._stopping = False
+                for i in range(self.size):
+                    t = threading.Thread(target=self._work, name='%s-%d' % (self.name, i))
+                    t.daemon = True
+                    t.start()
+                    self._threads.append(t)
+            heapq.heappush(self._tasks, (time.time() + delay, next(self._sequence), future, func, args, kwargs))
+            self._unfinished += 1
+            self._cond.notify_all()
+        return future
+
+    def join(self):
+        """ Block until all submitted tasks have been processed. """
+        with self._cond:
+            while self._unfinished > 0:
+                self._cond.wait()
+
+    def shut_down(self, timeout=None):
+        """ Process all pending tasks without waiting for their due time and stop the worker threads.
+        Returns a list of threads which did not terminate within `timeout` seconds. """
+        with self._cond:
+            threads, self._threads = self._threads, []
+            self._stopping = True
+            self._cond.notify_all()
+        deadline = None if timeout is None else time.time() + timeout
+        for t in threads:
+            t.join(None if deadline is None else max(0, deadline - time.time()))
+        return [t for t in threads if t.is_alive()]
+
+    def _next_task(self):
+        with self._cond:
+            while True:
+                wait = None
+                if self._tasks:
+                    wait = self._tasks[0][0] - time.time()
+                    if wait <= 0 or self._stopping:
+                        return heapq.heappop(self._tasks)
+                elif self._stopping:
+                    return None
+                self._cond.wait(wait)
+
+    def _work(self):
+        while True:
+            task = self._next_task()
+            if task is None:
+                break
+            _, _, future, func, args, kwargs = task
+            try:
+                if future._start():
+                    try:
+                        future._finish(result=func(*args, **kwargs))
+                    except Exception as e:
+                        logger.exception('Task %s of %s failed', func, self.name)
+                        future._finish(exception=e)
+            finally:
+                with self._cond:
+                    self._unfinished -= 1
+                    if self._unfinished == 0:
+                        self._cond.notify_all()
@@ -0,0 +1,117 @@
+try:
+    from builtins import object
+except ImportError:
+    pass
+
+import asyncio
+import threading
+from unittest import TestCase
+
+import rsb
+
+from rsbhsm.aio import AsyncRSBMachine
+
+try:
+    from unittest.mock import MagicMock
+except ImportError:
+    from mock import MagicMock
+
+
+class AsyncAction(object):
+
+    log = []
+
+    def __init__(self, *args, **kwargs):
+        self.model = kwargs['model']
+
+    async def enter(self, *args, **kwargs):
+        await asyncio.sleep(0.01)
+        self.log.append('enter')
+
+    async def exit(self, *args, **kwargs):
+        await asyncio.sleep(0.01)
+        self.log.append('exit')
+
+
+class TestAsyncRSB(TestCase):
+
+    TEST_SCOPE = '/test/aio'
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        AsyncAction.log = []
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_triggers(self):
+        model = MagicMock(spec=[])
+        m = AsyncRSBMachine(model, states=['A', 'B'], initial='A', transitions=[['advance', 'A', 'B']])
+        self.assertTrue(self.loop.run_until_complete(model.advance()))
+        self.assertEqual(model.state, 'B')
+        self.loop.run_until_complete(model.to_A())
+        self.assertEqual(model.state, 'A')
+        res = self.loop.run_until_complete(m.dispatch_batch([(model, 'advance', {}), (model, 'advance', {})]))
+        self.assertTrue(res[0])
+        self.assertIsInstance(res[1], Exception)
+        m.shut_down()
+
+    def test_async_actions(self):
+        model = MagicMock(spec=[])
+        m = AsyncRSBMachine(model, states=['A', {'name': 'B', 'action': AsyncAction}], initial='A',
+                            transitions=[['advance', 'A', 'B'], ['advance', 'B', 'A']])
+        self.loop.run_until_complete(model.advance())
+        self.assertEqual(AsyncAction.log, ['enter'])
+        self.loop.run_until_complete(model.advance())
+        self.assertEqual(AsyncAction.log, ['enter', 'exit'])
+        with self.assertRaises(ValueError):
+            m.add_states({'name': 'C', 'action': AsyncAction, 'async_action': True})
+        m.shut_down()
+
+    def test_action_triggers_own_model(self):
+
+        class Forward(AsyncAction):
+
+            async def enter(self, *args, **kwargs):
+                # the model is not locked while its actions are awaited
+                await self.model.advance()
+
+        model = MagicMock(spec=[])
+        m = AsyncRSBMachine(model, states=['A', {'name': 'B', 'action': Forward}, 'C'], initial='A',
+                            transitions=[['advance', 'A', 'B'], ['advance', 'B', 'C']])
+        self.assertTrue(self.loop.run_until_complete(asyncio.wait_for(model.advance(), 1)))
+        self.assertEqual(model.state, 'C')
+        m.shut_down()
+
+    def test_autostart(self):
+        model = MagicMock(spec=[])
+
+        async def create():
+            return AsyncRSBMachine(model, states=['A', 'B'], initial='A', autostart=True,
+                                   transitions=[{'trigger': 'advance', 'source': 'A', 'dest': 'B',
+                                                 'scope': self.TEST_SCOPE}])
+
+        m = self.loop.run_until_complete(create())
+        # listeners are activated in worker threads but use the loop of the caller
+        self.assertEqual(m.ready.result(timeout=1), 1)
+        self.assertIs(m.loop, self.loop)
+        self.assertIsNotNone(m.events['advance'].listener)
+        m.shut_down()
+
+    def test_rsb_bridge(self):
+        models = [MagicMock(spec=[]) for _ in range(3)]
+        m = AsyncRSBMachine(models, states=['A', 'B', 'C'], initial='A', loop=self.loop)
+        m.add_transition('advance', 'A', 'B', scope=self.TEST_SCOPE)
+        m.add_transition('go', 'B', 'C')
+        with self.assertRaises(ValueError):
+            m.add_transition('advance', 'B', 'C', scope=self.TEST_SCOPE, coalesce=True)
+        for model in models:
+            self.loop.run_until_complete(model.to_B())
+            self.loop.run_until_complete(model.to_A())
+        informer = rsb.createInformer(self.TEST_SCOPE, dataType=int)
+        # messages arrive in a foreign thread and are processed by the loop
+        threading.Thread(target=informer.publishData, args=(1,)).start()
+        self.loop.run_until_complete(asyncio.sleep(0.2))
+        self.assertEqual([model.state for model in models], ['B', 'B', 'B'])
+        del informer
+        m.shut_down()
@@ -0,0 +1,8 @@
+import sys
+from unittest import SkipTest
+
+if sys.version_info < (3, 5):
+    # the test cases use async syntax which cannot be compiled by older interpreters
+    raise SkipTest('asyncio support requires Python 3.5')
+
+from ._aio_cases import *  # noqa: F401,F403
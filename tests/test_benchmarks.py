@@ -0,0 +1,159 @@
+try:
+    from builtins import object
+except ImportError:
+    pass
+
+import os
+import subprocess
+import sys
+import threading
+import time
+from unittest import TestCase
+
+from rsbhsm import RSBHierarchicalStateMachine as Machine
+from rsbhsm import RSBMachineFactory
+
+
+def measure(func, repetitions):
+    start = time.time()
+    for _ in range(repetitions):
+        func()
+    return (time.time() - start) / repetitions
+
+
+# measurements are printed but not asserted since they depend on the load of the host
+class TestBenchmarks(TestCase):
+
+    def test_transition_latency(self):
+        # transition latency versus number of triggers with and without the cached listener table
+        print('\ntriggers  uncached [ms]  cached [ms]  lookup uncached [ms]  lookup cached [ms]')
+        for num in [10, 100, 500]:
+            states = ['A', 'B'] + ['S%d' % i for i in range(num)]
+            transitions = [['go', 'A', 'B'], ['go', 'B', 'A']]
+            transitions += [['t%d' % i, 'A', 'S%d' % i] for i in range(num)]
+            # graph styling would dominate the transition time of the default machine
+            m = RSBMachineFactory.get_predefined(locked=True)(states=states, transitions=transitions, initial='A',
+                                                              auto_transitions=False)
+
+            def uncached():
+                m._dest_listeners.clear()
+                m.go()
+
+            before = measure(uncached, 100)
+            after = measure(m.go, 100)
+            lookup_before = measure(lambda: m._compute_listeners('A'), 100)
+            lookup_after = measure(lambda: m._get_listeners('A'), 100)
+            print('%8d  %13.3f  %11.3f  %19.3f  %17.3f' % (num, before * 1000, after * 1000,
+                                                           lookup_before * 1000, lookup_after * 1000))
+
+    def test_import_time(self):
+        # importing rsbhsm must not load the RSB stack which is imported when it is actually needed
+        code = ('import sys, time; start = time.time(); import rsbhsm; print(time.time() - start); '
+                'print(sorted(m for m in ("rsb", "rst", "rstsandbox") if m in sys.modules))')
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        out = subprocess.check_output([sys.executable, '-c', code], cwd=root).decode().splitlines()
+        print('\nimport rsbhsm: %.3f s' % float(out[0]))
+        self.assertEqual(out[1], '[]')
+
+    def test_graph_free_import(self):
+        # machines without diagrams do not load the graph variants which require pygraphviz
+        if sys.version_info < (3, 7):
+            self.skipTest('graph variants are imported eagerly without module __getattr__')
+        code = ('import sys; from rsbhsm import RSBLockedHierarchicalMachine, RSBMachineFactory; '
+                'RSBMachineFactory.get_predefined(locked=True); print("rsbhsm.diagrams" in sys.modules)')
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        out = subprocess.check_output([sys.executable, '-c', code], cwd=root).decode().splitlines()
+        self.assertEqual(out[0], 'False')
+
+    def test_variant_throughput(self):
+        # transitions per second of each predefined machine variant
+        print('\nvariant                         transitions/s')
+        throughput = {}
+        for graph in [True, False]:
+            for locked in [True, False]:
+                machine_cls = RSBMachineFactory.get_predefined(graph=graph, locked=locked)
+                m = machine_cls(states=['A', 'B', {'name': 'C', 'children': ['1', '2']}], initial='A',
+                                transitions=[['go', 'A', 'B'], ['go', 'B', 'C'], ['go', 'C', 'A']])
+                throughput[machine_cls] = 1 / measure(m.go, 1000)
+                print('%-30s  %13.0f' % (machine_cls.__name__, throughput[machine_cls]))
+        m = Machine(states=['A', 'B', {'name': 'C', 'children': ['1', '2']}], initial='A', lazy_graph=True,
+                    transitions=[['go', 'A', 'B'], ['go', 'B', 'C'], ['go', 'C', 'A']])
+        lazy = 1 / measure(m.go, 1000)
+        print('%-30s  %13.0f' % ('lazy RSBHierarchicalStateMachine', lazy))
+
+    def test_lock_contention(self):
+        # throughput of models triggered from one thread each, with one machine lock and with per-model locks
+        def blocking():
+            time.sleep(0.001)
+
+        class Model(object):
+            pass
+
+        print('\nmodels  machine lock [1/s]  model locks [1/s]')
+        throughput = {}
+        for num in [1, 2, 4, 8]:
+            for mode in ['machine', 'model']:
+                models = [Model() for _ in range(num)]
+                m = RSBMachineFactory.get_predefined(locked=True)(models, states=['A', 'B'], initial='A',
+                                                                  lock_mode=mode, auto_transitions=False)
+                m.add_transition('go', 'A', 'B', before=blocking)
+                m.add_transition('go', 'B', 'A', before=blocking)
+
+                def run(model):
+                    for _ in range(50):
+                        model.go()
+
+                threads = [threading.Thread(target=run, args=(model,)) for model in models]
+                start = time.time()
+                for t in threads:
+                    t.start()
+                for t in threads:
+                    t.join()
+                throughput[(num, mode)] = num * 50 / (time.time() - start)
+            print('%6d  %18.0f  %16.0f' % (num, throughput[(num, 'machine')], throughput[(num, 'model')]))
+
+    def test_dispatch_batch(self):
+        # one trigger call per model compared to one batch for all models of a locked machine
+        class Model(object):
+            pass
+
+        print('\nmodels  single [ms]  batch [ms]')
+        for num in [10, 100, 1000]:
+            models = [Model() for _ in range(num)]
+            m = RSBMachineFactory.get_predefined(locked=True)(models, states=['A', 'B'], initial='A',
+                                                              auto_transitions=False,
+                                                              transitions=[['go', 'A', 'B'], ['go', 'B', 'A']])
+            items = [(model, 'go', {}) for model in models]
+
+            def single():
+                for model in models:
+                    model.go()
+
+            single_time = min(measure(single, 5) for _ in range(3))
+            batch_time = min(measure(lambda: m.dispatch_batch(items), 5) for _ in range(3))
+            print('%6d  %11.3f  %10.3f' % (num, single_time * 1000, batch_time * 1000))
+
+    def test_conditions(self):
+        # evaluation of named conditions by transitions' Condition and RSBCondition
+        from transitions.core import Condition, EventData
+
+        class Model(object):
+            def check(self, data):
+                return True
+
+        print('\nmachine                       Condition [us]  RSBCondition [us]')
+        for locked in [True, False]:
+            model = Model()
+            m = RSBMachineFactory.get_predefined(locked=locked)(model, states=['A', 'B'], initial='A')
+            m.add_transition('advance', 'A', 'B', conditions=['check'] * 10)
+            event_data = EventData(m.get_state('A'), m.events['advance'], m, model, args=(), kwargs={'data': 1})
+            bound = m.events['advance'].transitions['A'][0].conditions
+            plain = [Condition(c.func, c.target) for c in bound]
+
+            def evaluate(conditions):
+                for c in conditions:
+                    c.check(event_data)
+
+            default = min(measure(lambda: evaluate(plain), 2000) for _ in range(5))
+            rsb_condition = min(measure(lambda: evaluate(bound), 2000) for _ in range(5))
+            print('%-30s  %14.2f  %17.2f' % (type(m).__name__, default * 1e6, rsb_condition * 1e6))
@@ -3,7 +3,9 @@ try:
 except ImportError:
     pass
 
+import importlib
 import logging
+import threading
 import rsb
 import rst
 
@@ -16,9 +18,9 @@ from .test_threading import TestLockedHierarchicalTransitions as TestThreadedHSM
 from .test_threading import heavy_processing
 
 try:
-    from unittest.mock import MagicMock
+    from unittest.mock import MagicMock, patch
 except ImportError:
-    from mock import MagicMock
+    from mock import MagicMock, patch
 
 
 def condition_check(data):
@@ -29,6 +31,18 @@ def condition_check_rst(data):
     return data.int > 1
 
 
+class ShardModel(object):
+
+    def __init__(self, key, threshold=0):
+        self.key = key
+        self.threshold = threshold
+        self.received = []
+
+    def check(self, data):
+        self.received.append(data)
+        return data > self.threshold
+
+
 class TestRSBTransitions(TestThreadedHSM):
     TEST_SCOPE = '/test/transitions'
 
@@ -191,6 +205,789 @@ class TestRSBTransitions(TestThreadedHSM):
         self.assertTrue(m.events['bar'].activate.called)
         m.foo()
         self.assertEqual(m.state, 'B')
+        # listeners are deactivated in the background
+        m._reaper.join()
         # foo is still a valid event in state B. Should not be deactivated. 'bar' is not valid any longer
         self.assertFalse(m.events['foo'].deactivate.called)
         self.assertTrue(m.events['bar'].deactivate.called)
+
+    def test_listener_cache(self):
+        m = Machine(states=['A', 'B', 'C'], initial='A', auto_transitions=False)
+        m.add_transition('go', 'A', 'B')
+        m.add_transition('foo', 'B', 'C', scope='/foo')
+        m.go()
+        self.assertIn('B', m._dest_listeners)
+        self.assertEqual(m._get_listeners('B'), [m.events['foo']])
+        # adding transitions or states invalidates the table
+        m.add_transition('bar', 'B', 'A', scope='/bar')
+        self.assertEqual(len(m._dest_listeners), 0)
+        self.assertEqual(set(m._get_listeners('B')), set([m.events['foo'], m.events['bar']]))
+        m.add_state('D')
+        self.assertEqual(len(m._dest_listeners), 0)
+        m.shut_down()
+
+    def test_reaper(self):
+        s = ['0', 'A', 'B']
+        t = [{'trigger': 'go', 'source': '0', 'dest': 'A'},
+             {'trigger': 'foo', 'source': 'A', 'dest': 'B', 'scope': '/foo'}]
+        m = Machine(states=s, transitions=t, auto_transitions=False, initial='0')
+        m.events['foo'].deactivate = MagicMock()
+        m.go()
+        # nothing to deactivate; the worker should not have been started
+        self.assertEqual(len(m._reaper._threads), 0)
+        m.foo()
+        self.assertEqual(len(m._reaper._threads), 1)
+        m.shut_down()
+        # shut_down drains and joins the reaper before it deactivates all events again
+        self.assertEqual(len(m._reaper._threads), 0)
+        self.assertEqual(m.events['foo'].deactivate.call_count, 2)
+
+    def test_shared_listeners(self):
+        s = ['A', 'B', 'C']
+        t = [{'trigger': 'foo', 'source': 'A', 'dest': 'B', 'scope': self.TEST_SCOPE},
+             {'trigger': 'bar', 'source': 'A', 'dest': 'C', 'scope': self.TEST_SCOPE},
+             {'trigger': 'abort', 'source': ['A', 'B'], 'dest': 'C', 'scope': self.TEST_SCOPE}]
+        m = Machine(states=s, transitions=t, initial='C')
+        m.to_A()
+        self.assertEqual(len(m._scopes), 1)
+        listener = m.events['foo'].listener
+        self.assertIs(m.events['bar'].listener, listener)
+        self.assertIs(m.events['abort'].listener, listener)
+        m.to_B()
+        m._reaper.join()
+        # 'abort' is still valid and keeps the listener alive
+        self.assertEqual(len(m._scopes), 1)
+        self.assertIsNone(m.events['foo'].listener)
+        m.to_C()
+        m._reaper.join()
+        self.assertEqual(len(m._scopes), 0)
+        m.shut_down()
+
+    def test_scope_roots(self):
+        model = MagicMock(spec=[])
+        model.check_arm = MagicMock(return_value=False)
+        model.check_leg = MagicMock(return_value=False)
+        model.check_any = MagicMock(return_value=False)
+        t = [{'trigger': 'arm', 'source': 'A', 'dest': 'B', 'scope': '/test/robot/arm', 'conditions': 'check_arm'},
+             {'trigger': 'leg', 'source': 'A', 'dest': 'B', 'scope': '/test/robot/leg', 'conditions': 'check_leg'},
+             {'trigger': 'any', 'source': 'A', 'dest': 'B', 'scope': '/test/robot', 'conditions': 'check_any'}]
+        m = Machine(model, states=['A', 'B'], transitions=t, initial='B', scope_roots=['/test/robot'])
+        m.to(model, 'A')
+        # one listener on the root serves all subscopes
+        self.assertEqual(len(m._scopes), 1)
+        self.assertIs(m.events['arm'].listener, m.events['leg'].listener)
+        informer = rsb.createInformer('/test/robot/arm/joint', dataType=int)
+        informer.publishData(1)
+        time.sleep(0.1)
+        self.assertEqual(model.check_arm.call_count, 1)
+        self.assertEqual(model.check_any.call_count, 1)
+        self.assertEqual(model.check_leg.call_count, 0)
+        m.to(model, 'B')
+        m._reaper.join()
+        self.assertEqual(len(m._scopes), 0)
+        self.assertEqual(m._scopes._routers, {})
+        m.shut_down()
+
+    def test_concurrent_deactivation(self):
+        from rsbhsm import RSBLockedHierarchicalMachine
+        arrived = [threading.Event(), threading.Event()]
+        models = [MagicMock(spec=[]) for _ in range(2)]
+        for i, model in enumerate(models):
+            # both models exit A at the same time
+            model.meet = (lambda i: lambda: arrived[i].set() or arrived[1 - i].wait(1))(i)
+        m = RSBLockedHierarchicalMachine(models, states=[{'name': 'A', 'on_exit': 'meet'}, 'B'], initial='B',
+                                         lock_mode='model')
+        m.add_transition('adv', 'A', 'B', scope=self.TEST_SCOPE)
+        for model in models:
+            model.to_A()
+        threads = [threading.Thread(target=model.adv) for model in models]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        m._reaper.join()
+        self.assertEqual(m._count_models('adv'), 0)
+        self.assertFalse(m.events['adv'].active)
+        self.assertIsNone(m.events['adv'].listener)
+        m.shut_down()
+
+    def test_shared_listener_failure(self):
+        self.stuff.machine.add_transition('advance', 'A', 'B', conditions='test_condition', scope=self.TEST_SCOPE)
+        self.stuff.machine.add_transition('reset', 'A', 'A', conditions='test_reset', scope=self.TEST_SCOPE)
+        self.stuff.test_condition = MagicMock(side_effect=ValueError)
+        self.stuff.test_reset = MagicMock(side_effect=ValueError)
+        self.stuff.to_A()
+        self.stuff.informer.publishData(1)
+        time.sleep(0.1)
+        # a failing event does not prevent delivery to other events of the scope
+        self.assertEqual(self.stuff.test_condition.call_count, 1)
+        self.assertEqual(self.stuff.test_reset.call_count, 1)
+
+    def test_shared_listener_dispatch(self):
+        self.stuff.machine.add_transition('advance', 'A', 'B', conditions='test_condition', scope=self.TEST_SCOPE)
+        self.stuff.machine.add_transition('reset', 'A', 'A', conditions='test_reset', scope=self.TEST_SCOPE)
+        self.stuff.test_condition = MagicMock(return_value=False)
+        self.stuff.test_reset = MagicMock(return_value=False)
+        self.stuff.to_A()
+        self.stuff.informer.publishData(1)
+        time.sleep(0.1)
+        self.assertEqual(self.stuff.test_condition.call_count, 1)
+        self.assertEqual(self.stuff.test_reset.call_count, 1)
+
+    def test_listener_pool(self):
+        s = ['A', 'B', 'C']
+        t = [{'trigger': 'foo', 'source': 'A', 'dest': 'B', 'scope': '/foo'},
+             {'trigger': 'bar', 'source': 'B', 'dest': 'A', 'scope': '/bar'},
+             {'trigger': 'baz', 'source': 'C', 'dest': 'A', 'scope': '/baz'}]
+        m = Machine(states=s, transitions=t, initial='A', listener_pool=1)
+        m.to_A()
+        listener = m.events['foo'].listener
+        m.foo()
+        m._reaper.join()
+        self.assertEqual(m.listener_pool_stats(), {'hits': 0, 'misses': 2, 'evictions': 0, 'parked': 1})
+        m.bar()
+        m._reaper.join()
+        # the parked listener of '/foo' has been reused
+        self.assertIs(m.events['foo'].listener, listener)
+        self.assertEqual(m.listener_pool_stats(), {'hits': 1, 'misses': 2, 'evictions': 0, 'parked': 1})
+        m.to_C()
+        m._reaper.join()
+        # pool size is 1; '/bar' has been evicted in favour of '/foo'
+        self.assertEqual(m.listener_pool_stats(), {'hits': 1, 'misses': 3, 'evictions': 1, 'parked': 1})
+        m.shut_down()
+        self.assertEqual(m.listener_pool_stats()['parked'], 0)
+
+    def test_listener_pool_idle(self):
+        t = [{'trigger': 'foo', 'source': 'A', 'dest': 'B', 'scope': '/foo'}]
+        m = Machine(states=['A', 'B'], transitions=t, initial='A', listener_pool=5, listener_pool_idle=0.2)
+        m.to_A()
+        m.foo()
+        time.sleep(0.1)
+        self.assertEqual(m.listener_pool_stats()['parked'], 1)
+        time.sleep(0.2)
+        # evicted without using the pool again
+        self.assertEqual(len(m._scopes._pool), 0)
+        self.assertEqual(m.listener_pool_stats(), {'hits': 0, 'misses': 1, 'evictions': 1, 'parked': 0})
+        m.shut_down()
+
+    def test_linger(self):
+        self.stuff.machine.linger = 0.2
+        self.stuff.test_condition = MagicMock(return_value=False)
+        self.stuff.machine.add_transition('advance', 'A', 'B', conditions='test_condition', scope=self.TEST_SCOPE)
+        self.stuff.to_A()
+        listener = self.stuff.machine.events['advance'].listener
+        self.stuff.to_B()
+        # messages received while lingering are discarded
+        self.stuff.informer.publishData(1)
+        time.sleep(0.1)
+        self.assertFalse(self.stuff.test_condition.called)
+        self.stuff.to_A()
+        time.sleep(0.2)
+        # deactivation has been cancelled
+        self.assertIs(self.stuff.machine.events['advance'].listener, listener)
+        self.stuff.to_B()
+        self.stuff.machine._reaper.join()
+        self.assertIsNone(self.stuff.machine.events['advance'].listener)
+
+    def test_linger_reentered(self):
+        self.stuff.machine.linger = 0.2
+        self.stuff.machine.add_transition('advance', 'A', 'B', scope=self.TEST_SCOPE)
+        self.stuff.to_A()
+        listener = self.stuff.machine.events['advance'].listener
+        self.stuff.to_B()
+        time.sleep(0.1)
+        self.stuff.to_A()
+        self.stuff.to_B()
+        time.sleep(0.15)
+        # the first deactivation has been cancelled and the second one is still lingering
+        self.assertIs(self.stuff.machine.events['advance'].listener, listener)
+        self.stuff.machine._reaper.join()
+        self.assertIsNone(self.stuff.machine.events['advance'].listener)
+
+    def test_linger_transition(self):
+        self.stuff.machine.add_transition('advance', 'A', 'B', scope=self.TEST_SCOPE, linger=0.2)
+        self.stuff.machine.add_transition('reset', 'A', 'A', scope='/test/reset')
+        self.stuff.to_A()
+        self.stuff.to_B()
+        time.sleep(0.1)
+        # 'reset' does not linger
+        self.assertIsNone(self.stuff.machine.events['reset'].listener)
+        self.assertIsNotNone(self.stuff.machine.events['advance'].listener)
+        self.stuff.machine._reaper.join()
+        self.assertIsNone(self.stuff.machine.events['advance'].listener)
+
+    def test_converter_cache(self):
+        from rsbhsm import register_types, loaded_types
+        register_types(['rst.generic.Value'])
+        self.assertIn('rst.generic.Value', loaded_types())
+        registered = MagicMock()
+        with patch('rsb.converter.registerGlobalConverter', registered):
+            self.stuff.machine.add_transition('advance', 'A', 'B', type='rst.generic.Value', scope=self.TEST_SCOPE)
+            self.stuff.machine.add_transition('reset', 'B', 'A', type='rst.generic.Value', scope=self.TEST_SCOPE)
+        self.assertFalse(registered.called)
+
+    def test_variants(self):
+        from rsbhsm import RSBMachineFactory, RSBHierarchicalMachine, RSBLockedHierarchicalMachine
+        self.assertEqual(RSBMachineFactory.get_predefined(graph=True, locked=True), Machine)
+        self.assertEqual(RSBMachineFactory.get_predefined(locked=True), RSBLockedHierarchicalMachine)
+        self.assertEqual(RSBMachineFactory.get_predefined(), RSBHierarchicalMachine)
+        for graph in [True, False]:
+            for locked in [True, False]:
+                stuff = Stuff(['A', 'B', 'C'], machine_cls=RSBMachineFactory.get_predefined(graph=graph, locked=locked))
+                stuff.test_condition = MagicMock(return_value=False)
+                stuff.machine.add_transition('advance', 'A', 'B', conditions='test_condition', scope=self.TEST_SCOPE)
+                stuff.to_A()
+                self.assertIsNotNone(stuff.machine.events['advance'].listener)
+                self.stuff.informer.publishData(1)
+                time.sleep(0.1)
+                self.assertTrue(stuff.test_condition.called)
+                self.assertEqual(hasattr(stuff, 'get_graph'), graph)
+                stuff.machine.shut_down()
+
+    def test_lazy_graph(self):
+        states = ['A', 'B', {'name': 'C', 'children': ['1', '2']}]
+        transitions = [['go', 'A', 'B'], ['go', 'B', 'C'], ['go', 'C', 'A']]
+        m = Machine(states=states, transitions=transitions, initial='A', lazy_graph=True)
+        eager = Machine(states=states, transitions=transitions, initial='A')
+        graph = m.graph
+        m.go()
+        eager.go()
+        # transitions do not update the graph
+        self.assertNotEqual(graph.get_node('B').attr['color'], eager.graph.get_node('B').attr['color'])
+        self.assertIs(m.get_graph(), graph)
+        self.assertEqual(str(m.get_graph()), str(eager.get_graph()))
+        m.add_state('D')
+        m.go()
+        eager.add_state('D')
+        eager.go()
+        self.assertEqual(str(m.get_graph()), str(eager.get_graph()))
+
+    def test_lazy_action(self):
+        import rsbhsm.actions
+        with patch('importlib.import_module', wraps=importlib.import_module) as import_module:
+            x = State('X', action='mock.MagicMock', lazy_action=True)
+            y = State('Y', action='mock.MagicMock', lazy_action=True)
+            self.assertFalse(import_module.called)
+            self.stuff.machine.add_state([x, y])
+            self.stuff.to_X()
+            self.assertIsNotNone(x.action)
+            self.assertIsNone(y._action_cls)
+            self.stuff.machine.preload()
+            self.assertIsNotNone(y._action_cls)
+        # the path has been resolved only once
+        self.assertLessEqual(import_module.call_count, 1)
+        self.assertIn('mock.MagicMock', rsbhsm.actions._action_classes)
+
+    def test_action_lifecycle(self):
+        from rsbhsm import RSBLockedHierarchicalMachine
+        x = State('X', action=MagicMock, action_lifecycle='persistent')
+        y = State('Y', action=MagicMock, action_lifecycle='pooled', action_pool=1)
+        stuff, stuff2 = MagicMock(spec=[]), MagicMock(spec=[])
+        m = RSBLockedHierarchicalMachine([stuff, stuff2], states=['A', x, y], initial='A')
+        stuff.to_X()
+        action = x.action
+        stuff.to_A()
+        self.assertIsNone(x.action)
+        stuff.to_X()
+        # the action has been reused and entered/exited on every visit
+        self.assertIs(x.action, action)
+        self.assertEqual(action.enter.call_count, 2)
+        self.assertEqual(action.exit.call_count, 1)
+        stuff.to_Y()
+        action_y = y.action
+        stuff2.to_Y()
+        stuff2.to_A()
+        # pool size is 1 but the action of stuff is entered and must not be released
+        self.assertFalse(action_y.release.called)
+        self.assertEqual(len(y._kept_actions), 2)
+        stuff.to_A()
+        stuff2.to_Y()
+        self.assertTrue(action_y.release.called)
+        self.assertEqual(len(y._kept_actions), 1)
+        m.shut_down()
+        self.assertTrue(action.release.called)
+        self.assertEqual(len(x._kept_actions), 0)
+        with self.assertRaises(ValueError):
+            State('Z', action=MagicMock, action_lifecycle='forever')
+
+    def test_async_action(self):
+        from rsbhsm import RSBLockedHierarchicalMachine
+
+        class SlowAction(object):
+
+            def __init__(self, model):
+                self.model = model
+                self.exited = False
+
+            def enter(self):
+                time.sleep(0.3)
+
+            def exit(self):
+                self.exited = True
+
+        x = State('X', action=SlowAction, async_action=True)
+        y = State('Y', action=SlowAction, async_action=True)
+        m = RSBLockedHierarchicalMachine(states=['A', x, y], initial='A', action_workers=1)
+        start = time.time()
+        m.to_X()
+        # the transition does not wait for the action
+        self.assertLess(time.time() - start, 0.1)
+        time.sleep(0.05)
+        action_x = x.action
+        m.to_Y()
+        # X is still running; it is interrupted and exited once enter has returned
+        self.assertLess(time.time() - start, 0.2)
+        self.assertEqual(x.action_stats['interrupted'], 1)
+        self.assertTrue(action_x.cancelled.is_set())
+        self.assertFalse(action_x.exited)
+        action_y = y.action
+        m.to_A()
+        # Y's enter has been queued behind X's and is cancelled
+        self.assertEqual(y.action_stats['cancelled'], 1)
+        self.assertFalse(action_y.exited)
+        m.shut_down()
+        self.assertTrue(action_x.exited)
+        self.assertEqual(x.action_stats['runs'], 1)
+        self.assertGreaterEqual(x.action_stats['run_time'], 0.3)
+        self.assertEqual(y.action_stats['runs'], 0)
+
+    def test_async_action_done(self):
+        from rsbhsm import RSBLockedHierarchicalMachine
+
+        class Action(object):
+
+            def __init__(self, model):
+                self.model = model
+
+            def enter(self):
+                # leaves the state of the action from the action worker
+                self.model.to_C()
+
+            def exit(self):
+                pass
+
+        model = MagicMock(spec=[])
+        b = State('B', action=Action, async_action=True)
+        m = RSBLockedHierarchicalMachine(model, states=['A', b, 'C'], initial='A')
+        model.to_B()
+        m._action_workers.join()
+        self.assertEqual(model.state, 'C')
+        model.to_A()
+        self.assertEqual(model.state, 'A')
+        m.shut_down()
+
+    def test_async_action_interrupted(self):
+        from rsbhsm import RSBLockedHierarchicalMachine
+        log = []
+
+        class Action(object):
+
+            def __init__(self, model):
+                self.model = model
+
+            def enter(self):
+                time.sleep(0.1)
+                log.append('enter')
+                # the state has been left in the meantime
+                self.model.to_C()
+
+            def exit(self):
+                log.append('exit')
+
+        model = MagicMock(spec=[])
+        b = State('B', action=Action, async_action=True)
+        m = RSBLockedHierarchicalMachine(model, states=['A', b, 'C'], initial='A')
+        model.to_B()
+        time.sleep(0.02)
+        start = time.time()
+        model.to_A()
+        self.assertLess(time.time() - start, 0.05)
+        m._action_workers.join()
+        # the trigger of the stale enter is ignored and exit is called after enter
+        self.assertEqual(model.state, 'A')
+        self.assertEqual(log, ['enter', 'exit'])
+        m.shut_down()
+
+    def test_model_routing(self):
+        from rsbhsm import RSBLockedHierarchicalMachine
+        models = [MagicMock(spec=[]) for _ in range(3)]
+        for model in models:
+            model.test_condition = MagicMock(return_value=False)
+        states = ['A', 'B', {'name': 'C', 'children': ['1', '2']}]
+        m = RSBLockedHierarchicalMachine(models, states=states, initial='A')
+        m.add_transition('advance', 'C', 'B', conditions='test_condition', scope=self.TEST_SCOPE)
+        models[0].to_B()
+        models[1].to_C()
+        # the separator may differ between test runs
+        m.set_state([s for s in m.states if s.startswith('C') and s != 'C'][0], model=models[2])
+        self.assertEqual(len(m._get_models_for('advance')), 2)
+        self.stuff.informer.publishData(1)
+        time.sleep(0.1)
+        # only models in C or its substates are triggered
+        self.assertFalse(models[0].test_condition.called)
+        self.assertTrue(models[1].test_condition.called)
+        self.assertTrue(models[2].test_condition.called)
+        m.remove_model(models[1])
+        self.assertEqual(m._get_models_for('advance'), [models[2]])
+        m.shut_down()
+
+    def test_model_routing_changed_state(self):
+        from rsbhsm import RSBLockedHierarchicalMachine
+        models = [MagicMock(spec=[]) for _ in range(3)]
+        for model in models:
+            model.check = MagicMock(return_value=False)
+        # the first model moves the second one out of A before its trigger is processed
+        models[0].check.side_effect = lambda data: models[1].to_B() and False
+        m = RSBLockedHierarchicalMachine(models, states=['A', 'B'], initial='A')
+        m.add_transition('advance', 'A', 'B', conditions='check', scope=self.TEST_SCOPE)
+        m.start().result(timeout=1)
+        self.stuff.informer.publishData(1)
+        time.sleep(0.1)
+        self.assertFalse(models[1].check.called)
+        self.assertTrue(models[2].check.called)
+        m.shut_down()
+
+    def test_model_lock_mode(self):
+        from rsbhsm import RSBLockedHierarchicalMachine, RSBHierarchicalMachine
+        with self.assertRaises(ValueError):
+            RSBHierarchicalMachine(states=['A', 'B'], initial='A', lock_mode='model')
+        with self.assertRaises(ValueError):
+            RSBLockedHierarchicalMachine(states=['A', 'B'], initial='A', lock_mode='unknown')
+        blocker = threading.Event()
+        models = [MagicMock(spec=[]), MagicMock(spec=[])]
+        models[0].wait = MagicMock(side_effect=lambda: blocker.wait(1))
+        models[1].wait = MagicMock()
+        m = RSBLockedHierarchicalMachine(models, states=['A', 'B'], initial='A', lock_mode='model')
+        m.add_transition('advance', 'A', 'B', before='wait')
+        t = threading.Thread(target=models[0].advance)
+        t.start()
+        time.sleep(0.05)
+        # the first model blocks in its callback but the second one is not affected
+        models[1].advance()
+        self.assertEqual(models[1].state, 'B')
+        self.assertEqual(models[0].state, 'A')
+        blocker.set()
+        t.join()
+        self.assertEqual(models[0].state, 'B')
+        m.shut_down()
+
+    def test_model_lock_mode_listener_creation(self):
+        from rsbhsm import RSBLockedHierarchicalMachine
+        creating = threading.Event()
+        release = threading.Event()
+        create_listener = rsb.createListener
+
+        def slow_listener(scope, *args, **kwargs):
+            creating.set()
+            release.wait(1)
+            return create_listener(scope, *args, **kwargs)
+
+        models = [MagicMock(spec=[]), MagicMock(spec=[])]
+        m = RSBLockedHierarchicalMachine(models, states=['A', 'B', 'C'], initial='A', lock_mode='model')
+        m.add_transition('advance', 'B', 'C', scope=self.TEST_SCOPE)
+        with patch('rsb.createListener', side_effect=slow_listener):
+            t = threading.Thread(target=models[0].to_B)
+            t.start()
+            creating.wait(1)
+            start = time.time()
+            # creating the listener for the first model does not block transitions of the second one
+            models[1].to_C()
+            self.assertLess(time.time() - start, 0.5)
+            release.set()
+            t.join()
+        self.assertIsNotNone(m.events['advance'].listener)
+        m.shut_down()
+
+    def test_inbox_policies(self):
+        from rsbhsm.listeners import Inbox
+        with self.assertRaises(ValueError):
+            Inbox(2, 'unknown')
+        for policy, expected in [('drop_oldest', [3, 4]), ('drop_newest', [1, 2]), ('latest_only', [4])]:
+            inbox = Inbox(2, policy)
+            # only the first put has to start draining
+            self.assertEqual([inbox.put(i) for i in range(1, 5)], [True, False, False, False])
+            self.assertEqual(inbox.get_batch(1), expected[:1])
+            self.assertEqual(inbox.get_batch(10), expected[1:])
+            # an empty batch marks the inbox as idle
+            self.assertEqual(inbox.get_batch(10), [])
+            self.assertEqual(inbox.stats()['dropped'], 4 - len(expected))
+            self.assertTrue(inbox.put(5))
+        inbox = Inbox(1, 'block')
+        inbox.put(1)
+        t = threading.Thread(target=inbox.put, args=(2,))
+        t.start()
+        time.sleep(0.05)
+        self.assertTrue(t.is_alive())
+        inbox.get_batch(1)
+        t.join(1)
+        self.assertFalse(t.is_alive())
+        self.assertEqual(inbox.stats(), {'received': 2, 'dropped': 0, 'max_depth': 1, 'depth': 1})
+
+    def test_queued_event(self):
+        from rsbhsm import RSBLockedHierarchicalMachine
+        blocker = threading.Event()
+        model = MagicMock(spec=[])
+        model.check = MagicMock(side_effect=lambda data: blocker.wait(1) and False)
+        m = RSBLockedHierarchicalMachine(model, states=['A', 'B'], initial='A')
+        m.add_transition('advance', 'A', 'B', conditions='check', scope=self.TEST_SCOPE,
+                         queue_size=2, queue_policy='drop_oldest')
+        model.to_B()
+        model.to_A()
+        self.stuff.informer.publishData(1)
+        time.sleep(0.05)
+        # the dispatcher is blocked by the first message; two of the remaining four are dropped
+        for i in range(2, 6):
+            self.stuff.informer.publishData(i)
+            time.sleep(0.02)
+        # machine methods wait for the lock held by the dispatcher; event statistics do not
+        stats = m.events['advance'].queue_stats()
+        self.assertEqual(stats['depth'], 2)
+        self.assertEqual(stats['dropped'], 2)
+        blocker.set()
+        m._dispatcher.join()
+        self.assertEqual([c[1]['data'] for c in model.check.call_args_list], [1, 4, 5])
+        self.assertEqual(m.queue_stats()['advance']['depth'], 0)
+        m.shut_down()
+
+    def test_coalesce(self):
+        from rsbhsm import RSBLockedHierarchicalMachine
+        blocker = threading.Event()
+        model = MagicMock(spec=[])
+        model.check = MagicMock(side_effect=lambda data: blocker.wait(1) and False)
+        with self.assertRaises(ValueError):
+            RSBLockedHierarchicalMachine(states=['A', 'B'], initial='A').add_transition(
+                'advance', 'A', 'B', scope=self.TEST_SCOPE, coalesce=True, queue_policy='block')
+        m = RSBLockedHierarchicalMachine(model, states=['A', 'B'], initial='A')
+        m.add_transition('advance', 'A', 'B', conditions='check', scope=self.TEST_SCOPE, coalesce=True)
+        model.to_B()
+        model.to_A()
+        for i in range(1, 6):
+            self.stuff.informer.publishData(i)
+            time.sleep(0.02)
+        blocker.set()
+        m._dispatcher.join()
+        # the first message is processed while the others arrive; only the newest of them is kept
+        self.assertEqual([c[1]['data'] for c in model.check.call_args_list], [1, 5])
+        self.assertEqual(m.queue_stats()['advance']['dropped'], 3)
+        m.shut_down()
+
+    def test_dispatch_batch(self):
+        from transitions.core import MachineError
+        from rsbhsm import RSBLockedHierarchicalMachine
+        models = [MagicMock(spec=[]) for _ in range(3)]
+        for model in models:
+            model.check = MagicMock(return_value=True)
+        m = RSBLockedHierarchicalMachine(models, states=['A', 'B', 'C'], initial='A')
+        m.add_transition('advance', 'A', 'B', conditions='check')
+        m.add_transition('advance', 'B', 'C')
+        models[2].to_C()
+        items = [(models[0], 'advance', {'data': 1}), (models[0], 'advance', {}), (models[1], 'advance', {}),
+                 (models[2], 'advance', {})]
+        res = m.dispatch_batch(items)
+        self.assertEqual(res[:3], [True, True, True])
+        self.assertIsInstance(res[3], MachineError)
+        self.assertEqual([model.state for model in models], ['C', 'B', 'C'])
+        models[0].check.assert_called_once_with(data=1)
+        self.assertEqual(m.dispatch_batch(items[2:], ignore_invalid=True), [True, False])
+        self.assertEqual(models[1].state, 'C')
+
+    def test_rsb_conditions(self):
+        from rsbhsm import RSBCondition, RSBLockedHierarchicalMachine
+
+        class Model(object):
+            def check(self, data):
+                return data > 0
+
+        model = Model()
+        m = RSBLockedHierarchicalMachine(model, states=['A', 'B', 'C'], initial='A')
+        m.add_transition('advance', 'A', 'B', conditions='check')
+        m.add_transition('advance', 'B', 'C', unless='check')
+        for transitions in m.events['advance'].transitions.values():
+            self.assertIsInstance(transitions[0].conditions[0], RSBCondition)
+        self.assertFalse(model.advance(data=0))
+        self.assertTrue(model.advance(data=1))
+        # reassigned attributes are used
+        model.check = MagicMock(return_value=False)
+        self.assertTrue(model.advance(data=1))
+        self.assertEqual(model.state, 'C')
+        model.check.assert_called_once_with(data=1)
+        # changes of send_event apply to existing conditions
+        m.send_event = True
+        model.to_A()
+        model.check = MagicMock(return_value=True)
+        self.assertTrue(model.advance(data=1))
+        self.assertIs(model.check.call_args[0][0].model, model)
+
+    def test_filter(self):
+        from rsbhsm import RSBLockedHierarchicalMachine
+        model = MagicMock(spec=[])
+        model.check = MagicMock(return_value=False)
+        native = MagicMock(spec=['match'])
+        native.match = MagicMock(side_effect=lambda ev: ev.data != 4)
+        m = RSBLockedHierarchicalMachine(model, states=['A', 'B'], initial='A')
+        m.add_transition('advance', 'A', 'B', conditions='check', scope=self.TEST_SCOPE,
+                         filter=[lambda data: data > 2, native])
+        model.to_B()
+        model.to_A()
+        for i in range(1, 6):
+            self.stuff.informer.publishData(i)
+        time.sleep(0.1)
+        # 1 and 2 are rejected by the predicate and 4 by the RSB filter
+        self.assertEqual(sorted(c[1]['data'] for c in model.check.call_args_list), [3, 5])
+        self.assertEqual(m.message_stats(), {'advance': {'filtered': 3, 'dispatched': 2}})
+        m.shut_down()
+
+    def test_shared_model_listeners(self):
+        from rsbhsm import RSBLockedHierarchicalMachine
+        models = [MagicMock(spec=[]) for _ in range(3)]
+        for model in models:
+            model.check = MagicMock(return_value=False)
+        m = RSBLockedHierarchicalMachine(models, states=['A', 'B'], initial='B')
+        m.add_transition('advance', 'A', 'B', conditions='check', scope=self.TEST_SCOPE)
+        for model in models:
+            model.to_A()
+        event = m.events['advance']
+        self.assertEqual(m._count_models('advance'), 3)
+        models[0].to_B()
+        models[1].to_B()
+        m._reaper.join()
+        # the last model in A still requires the listener
+        self.assertTrue(event.active)
+        self.assertIsNotNone(event.listener)
+        self.stuff.informer.publishData(1)
+        time.sleep(0.1)
+        self.assertTrue(models[2].check.called)
+        self.assertFalse(models[0].check.called)
+        m.remove_model(models[2])
+        m._reaper.join()
+        self.assertEqual(m._count_models('advance'), 0)
+        self.assertIsNone(event.listener)
+        m.shut_down()
+
+    def test_sharding(self):
+        from rsbhsm.sharding import ShardedMachine
+        sharded = ShardedMachine(ShardModel, shards=2, states=['A', 'B', 'C'], initial='A',
+                                 transitions=[{'trigger': 'advance', 'source': 'A', 'dest': 'B',
+                                               'conditions': 'check', 'scope': self.TEST_SCOPE},
+                                              ['go', 'B', 'C']])
+        keys = ['model%d' % i for i in range(6)]
+        for key in keys:
+            self.assertEqual(sharded.add_model(key, 1), 'A')
+        # keys are distributed by a stable hash
+        self.assertEqual(set(sharded.shard_of(key) for key in keys), set([0, 1]))
+        self.assertTrue(sharded.trigger('model0', 'to_C'))
+        sharded._reaper.join()
+        self.stuff.informer.publishData(2)
+        time.sleep(0.2)
+        states = sharded.states()
+        self.assertEqual(states.pop('model0'), 'C')
+        self.assertEqual(set(states.values()), set(['B']))
+        self.assertEqual(sharded.collect('received'), dict([('model0', [])] + [(key, [2]) for key in keys[1:]]))
+        with self.assertRaises(Exception):
+            sharded.trigger('model0', 'go')
+        # no model requires the listener any longer
+        sharded._reaper.join()
+        self.assertEqual(len(sharded._scopes), 0)
+        sharded.remove_model('model1')
+        self.assertNotIn('model1', sharded.states())
+        sharded.shut_down()
+        with self.assertRaises(ValueError):
+            ShardedMachine(ShardModel, states=['A', 'B'], initial='A',
+                           transitions=[{'trigger': 'advance', 'source': 'A', 'dest': 'B', 'scope': self.TEST_SCOPE,
+                                         'coalesce': True}])
+
+    def test_shut_down_running_action(self):
+        from rsbhsm import RSBLockedHierarchicalMachine
+
+        class Action(object):
+
+            def __init__(self, model):
+                self.model = model
+
+            def enter(self):
+                time.sleep(0.1)
+                # requires the machine lock while the machine is shut down
+                self.model.to_A()
+
+            def exit(self):
+                pass
+
+        model = MagicMock(spec=[])
+        b = State('B', action=Action, async_action=True)
+        m = RSBLockedHierarchicalMachine(model, states=['A', b], initial='A')
+        model.to_B()
+        time.sleep(0.05)
+        report = m.shut_down(timeout=2)
+        self.assertEqual(report['threads'], [])
+        self.assertEqual(model.state, 'A')
+
+    def test_shut_down_timeout(self):
+        from rsbhsm import RSBLockedHierarchicalMachine
+        m = RSBLockedHierarchicalMachine(states=['A', 'B'], initial='B')
+        scopes = ['/test/shutdown/%d' % i for i in range(8)]
+        for i, scope in enumerate(scopes):
+            m.add_transition('t%d' % i, 'A', 'B', scope=scope)
+        m.to_A()
+        for sub in m._scopes._subscriptions.values():
+            sub.listener.deactivate = lambda: time.sleep(0.3)
+        start = time.time()
+        report = m.shut_down(timeout=2)
+        # listeners are destroyed concurrently
+        self.assertLess(time.time() - start, 0.3 * len(scopes) / 2)
+        self.assertEqual(report, {'listeners': [], 'threads': [], 'cancelled': 0})
+        m.add_transition('t8', 'B', 'A', scope='/test/shutdown/8')
+        m.to_A()
+        m.to_B()
+        m._reaper.join()
+        blocked = list(m._scopes._subscriptions.values())[0]
+        blocked.listener.deactivate = lambda: time.sleep(1)
+        start = time.time()
+        report = m.shut_down(timeout=0.2)
+        self.assertLess(time.time() - start, 0.5)
+        self.assertEqual(report['listeners'], ['/test/shutdown/8'])
+        self.assertEqual(len(report['threads']), 1)
+
+    def test_start(self):
+        from rsbhsm import RSBLockedHierarchicalMachine
+        create_listener = rsb.createListener
+
+        def slow_listener(scope, *args, **kwargs):
+            time.sleep(0.2)
+            return create_listener(scope, *args, **kwargs)
+
+        t = [{'trigger': 't%d' % i, 'source': 'A', 'dest': 'B', 'scope': '/test/start/%d' % i} for i in range(6)]
+        t.append({'trigger': 'back', 'source': 'B', 'dest': 'A', 'scope': '/test/start/back'})
+        with patch('rsb.createListener', side_effect=slow_listener):
+            start = time.time()
+            m = RSBLockedHierarchicalMachine(states=['A', 'B'], transitions=t, initial='A', autostart=True)
+            self.assertEqual(m.ready.result(timeout=2), 6)
+            # listeners are created concurrently
+            self.assertLess(time.time() - start, 0.2 * 6 / 2)
+        self.assertTrue(all(m.events['t%d' % i].listener is not None for i in range(6)))
+        self.assertIsNone(m.events['back'].listener)
+        m.shut_down()
+        m = RSBLockedHierarchicalMachine(states=['A', 'B'], transitions=t, initial='A')
+        self.assertIsNone(m.ready)
+        self.assertIsNone(m.events['t0'].listener)
+        self.assertEqual(m.start().result(timeout=1), 6)
+        m.shut_down()
+
+    def test_start_model_left(self):
+        from rsbhsm import RSBLockedHierarchicalMachine
+        create_listener = rsb.createListener
+
+        def slow_listener(scope, *args, **kwargs):
+            time.sleep(0.2)
+            return create_listener(scope, *args, **kwargs)
+
+        t = [{'trigger': 't%d' % i, 'source': 'A', 'dest': 'B', 'scope': '/test/start/%d' % i} for i in range(2)]
+        with patch('rsb.createListener', side_effect=slow_listener):
+            m = RSBLockedHierarchicalMachine(states=['A', 'B'], transitions=t, initial='A', autostart=True)
+            # the model leaves while the listeners are created
+            time.sleep(0.05)
+            m.to_B()
+            self.assertEqual(m.ready.result(timeout=2), 0)
+        m._reaper.join()
+        self.assertTrue(all(m.events['t%d' % i].listener is None for i in range(2)))
+        self.assertEqual(len(m._scopes), 0)
+        m.shut_down()